@@ -32,7 +32,8 @@
 import io, os
 #import sys,
 import signal, re
-import logging, json
+import select, errno, fcntl
+import logging, json, itertools
 from threading import Thread
 import time
 #import atexit
@@ -49,11 +50,22 @@ def signal_handler(signum, frame):
 	logger.info("Received signal %d" % signum)
 	keepcycling = False
 
+#SIGUSR1 asks ciao to dump its statistics into the log
+def stats_handler(signum, frame):
+	global dump_stats
+	dump_stats = True
+
+def log_stats():
+	for mcu in mcus:
+		logger.info("%s stats: %s" % (mcu.name, mcu.get_stats()))
+		for name, connector in sessions[mcu].items():
+			logger.info("%s %s stats: %s" % (mcu.name, name, connector.get_stats()))
+
 def __kill_connectors():
-	#stopping connectors (managed)
-	for name, connector in shd.items():
+	#stopping connectors (managed), the process is shared by every mcu
+	for name, connectors in shd.items():
 		logger.info("Sending stop signal to %s" % name)
-		connector.stop()
+		connectors[0].stop()
 
 #opening logfile
 logger = get_logger("ciao")
@@ -66,11 +78,26 @@ if not "connectors" in settings.conf or len(settings.conf["connectors"]) == 0:
 	logger.critical("No connector enabled, exiting.")
 	sys.exit(1)
 
-#creating shared dictionary
+#creating shared dictionary: connector name => list of CiaoConnector (one for each mcu)
 shd = {}
 
-#get the board model from cpuinfo
-board_model = get_board_model()
+#connectors seen by each mcu: mcu => { connector name => CiaoConnector }
+# every mcu has its own stash namespace, while connector processes are shared
+sessions = {}
+
+#self-pipe: signals and other threads (e.g. results from connectors) write a byte
+# into it, so select wakes up immediately (python signal handlers run only once
+# the main thread is back from select)
+wakeup_r, wakeup_w = os.pipe()
+for fd in (wakeup_r, wakeup_w):
+	fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+def wakeup():
+	try:
+		os.write(wakeup_w, "\0")
+	except OSError, e:
+		#pipe full: the main loop has already been woken up
+		pass
 
 #kill previous connectors
 kill_connectors_by_pids()
@@ -80,21 +107,35 @@ server = Thread(name="server", target=ciaoserver.init, args=(settings.conf,shd,)
 server.daemon = True
 server.start()
 
-mcu = None
+mcus = []
+
+mcus_conf = settings.conf["mcus"]
+if len(mcus_conf) == 0:
+	#get the board model from cpuinfo
+	board_model = get_board_model()
+	if board_model in settings.boards:
+		mcus_conf = [ settings.boards[board_model] ]
+	else:
+		logger.error("No MCU configured and unknown board model: %s" % board_model)
+
+for mcu_conf in mcus_conf:
+	logger.debug("Ciao MCU Connection starting via %s" % mcu_conf["type"])
+	try:
+		mcu = ciaomcu.create(mcu_conf, logger)
+		mcu.start()
+	except Exception, e:
+		logger.error("Ciao MCU Connection via %s failed: %s" % (mcu_conf["type"], e))
+	else:
+		mcus.append(mcu)
+		logger.info("Ciao MCU Connection started via %s" % mcu_conf["type"])
 
-if board_model == "ARDUINO YUN" or board_model == "ARDUINO YUN-MINI" or board_model == "ARDUINO CHIWAWA" or board_model == "LININO ONE":
-	logger.debug("Ciao MCU Connection starting via standard output")
-	mcu = ciaomcu.StdIO(settings, logger)
-	mcu.start()
-	logger.info("Ciao MCU Connection started via standard output")
+if len(mcus) == 0:
+	logger.critical("No MCU connection available, exiting.")
+	sys.exit(1)
 
-elif board_model == "ARDUINO TIAN":
-	logger.debug("Ciao MCU Connection starting via serial")
-	baud = settings.conf["tian"]["baud"]
-	port = settings.conf["tian"]["port"]
-	mcu = ciaomcu.Serial(port, baud, logger)
-	mcu.start()
-	logger.info("Ciao MCU Connection started via serial")
+for index, mcu in enumerate(mcus):
+	mcu.name = "mcu%d" % index
+	sessions[mcu] = {}
 
 #we start MANAGED connectors after ciaoserver (so they can register properly)
 core_version = settings.conf["core"]
@@ -106,10 +147,16 @@ for connector, connector_conf in settings.conf['connectors'].items():
 	if not ( check_version(required_version, core_version) ):
 		logger.error("Required version of Ciao Core [%s] for the connector %s is not compatible with the working Core version [%s]" %(required_version, connector, core_version ))
 	else:
-		shd[connector] = CiaoConnector(connector, connector_conf, mcu)
+		#ids are shared by the instances of a connector, so they identify the mcu too
+		ids = itertools.count(1)
+		instances = []
+		for mcu in mcus:
+			sessions[mcu][connector] = CiaoConnector(connector, connector_conf, mcu, wakeup = wakeup, ids = ids, notify = ciaoserver.wakeup)
+			instances.append(sessions[mcu][connector])
+		shd[connector] = instances
 		# connector must start after it has been added to shd,
 		# it can register only if listed in shd
-		shd[connector].start()
+		shd[connector][0].start()
 		#__attach_connector(connector)
 
 '''
@@ -133,58 +180,148 @@ keepcycling = True
 signal.signal(signal.SIGINT, signal_handler) #ctrl+c
 signal.signal(signal.SIGHUP, signal_handler) #SIGHUP - 1
 signal.signal(signal.SIGTERM, signal_handler) #SIGTERM - 15
+signal.signal(signal.SIGUSR1, stats_handler) #SIGUSR1 - dump stats
+dump_stats = False
+
+signal.set_wakeup_fd(wakeup_w)
+
+# pick the next connector with inbound messages for "ciao;r;any", connectors
+# are chosen with a smooth weighted round robin (weight from their configuration)
+def next_inbound_connector(mcu):
+	selected = None
+	total = 0
+	#only connectors holding messages of the highest priority class compete
+	candidates = [ connector for connector in sessions[mcu].values() if connector.has_inbound() ]
+	if candidates:
+		best = min(connector.fifo["in"].head_class() for connector in candidates)
+		candidates = [ connector for connector in candidates if connector.fifo["in"].head_class() == best ]
+	for connector in candidates:
+		connector.current_weight += connector.weight
+		total += connector.weight
+		if selected is None or connector.current_weight > selected.current_weight:
+			selected = connector
+	if not selected is None:
+		selected.current_weight -= total
+	return selected
+
+def handle_command(mcu, cmd):
+	global keepcycling
+	logger.debug("command (%s): %s" % (mcu.name, cmd))
+	#a valid command must contain at least two fields: connector and action,
+	# the line is scanned once, the remaining data is split by the connector
+	connector, sep, data = cmd.partition(";")
+	action, has_data, data = data.partition(";")
+	if not sep or not action in settings.actions_map:
+		if cmd != "run-ciao":
+			logger.warning("unknow command: %s" % cmd)
+			mcu.write(-1, "unknown_command")
+		# else : in this case ciao.py received run-ciao and it must discard the commands
+	elif connector in sessions[mcu]:
+		sessions[mcu][connector].run(action, data)
+	elif connector == "ciao": #internal commands
+		if not has_data:
+			mcu.write(-1, "unknown_command")
+		elif action == "r" and data == "status": #read status
+			mcu.write(1, "running")
+		elif action == "r" and data == "any": #read from any connector
+			connector = next_inbound_connector(mcu)
+			if connector is None:
+				mcu.write(0, "no_message")
+			else:
+				connector.read_inbound(tagged=True)
+		elif action == "w" and data == "quit": #stop ciao
+			mcu.write(1, "done")
+			keepcycling = False
+			__kill_connectors()
+		else:
+			#every command must get its reply (batch replies are matched by position)
+			mcu.write(-1, "unknown_command")
+	elif not connector in settings.conf['connectors']:
+		logger.warning("unknown connector: %s" % cmd)
+		mcu.write(-1, "unknown_connector")
+	else:
+		logger.warning("connector not runnable: %s" % cmd)
+		mcu.write(-1, "connector_not_runnable")
+
+# a batch frame packs many commands into one line, they are dispatched in order
+# and their replies go back to the mcu packed (in the same order) into one frame
+def handle_batch(mcu, frame):
+	mcu.begin_batch()
+	for cmd in frame.split(settings.BATCH_SEP_CODE):
+		handle_command(mcu, cmd)
+	mcu.end_batch()
+
+# consume every complete command the mcu transport has already buffered,
+# select would not report them since they are no longer in the kernel
+def read_commands(mcu):
+	while keepcycling:
+		try:
+			cmd = clean_command(mcu.read())
+		except KeyboardInterrupt, e:
+			logger.warning("SIGINT received")
+		except IOError, e:
+			logger.warning("Interrupted system call: %s" %e)
+		else:
+			if settings.BATCH_SEP_CODE in cmd:
+				handle_batch(mcu, cmd)
+			elif cmd:
+				handle_command(mcu, cmd)
+		if not mcu.pending():
+			break
 
 # Before start reading from micro controller, flushes data and cleans the buffer.
 # Usually mcu starts to write into buffer before ciao begins to read.
-mcu.flush()
+for mcu in mcus:
+	mcu.flush()
+
+# the earliest deadline of the result requests held by connectors or of the
+# mcu transports maintenance, e.g. reconnection (None if there are not)
+def next_deadline():
+	deadlines = [ connector.next_deadline() for connectors in shd.values() for connector in connectors ]
+	deadlines += [ mcu.next_deadline() for mcu in mcus ]
+	deadlines = [ deadline for deadline in deadlines if not deadline is None ]
+	return min(deadlines) if deadlines else None
 
 while keepcycling:
+	# ciao sleeps until an mcu writes something, a signal arrives, a connector
+	# provides a result or a result request held by a connector expires
+	deadline = next_deadline()
+	timeout = None if deadline is None else max(deadline - time.time(), 0)
 	try:
-		cmd = clean_command(mcu.read())
-	except KeyboardInterrupt, e:
-		logger.warning("SIGINT received")
-	except IOError, e:
-		logger.warning("Interrupted system call: %s" %e)
-	else:
-		if cmd:
-			logger.debug("command: %s" % cmd)
-			connector, action = is_valid_command(cmd)
-			if connector == False:
-				if cmd != "run-ciao":
-					logger.warning("unknow command: %s" % cmd)
-					mcu.write(-1, "unknown_command")
-				# else : in this case ciao.py received run-ciao and it must discard the commands
-			elif connector == "ciao": #internal commands
-				params = cmd.split(";",2)
-				if len(params) != 3:
-					mcu.write(-1, "unknown_command")
-					continue
-				if action == "r" and params[2] == "status": #read status
-					mcu.write(1, "running")
-				elif action == "w" and params[2] == "quit": #stop ciao
-					mcu.write(1, "done")
-					keepcycling = False
-					__kill_connectors()
-			elif not connector in settings.conf['connectors']:
-				logger.warning("unknown connector: %s" % cmd)
-				mcu.write(-1, "unknown_connector")
-			elif not connector in shd:
-				logger.warning("connector not runnable: %s" % cmd)
-				mcu.write(-1, "connector_not_runnable")
-			else:
-				shd[connector].run(action, cmd)
-				'''
-				if not connector in shd:
-					__attach_connector(connector)
-					mcu.write(0, "no_connector")
-				else:
-					shd[connector].run(action, cmd)
-				'''
+		readable, writable, exceptional = select.select([ mcu for mcu in mcus if mcu.ready() ] + [wakeup_r], [], [], timeout)
+	except select.error, e:
+		if e.args[0] != errno.EINTR:
+			raise
+		continue
+
+	if wakeup_r in readable:
+		try:
+			os.read(wakeup_r, 512)
+		except OSError, e:
+			pass
+
+	now = time.time()
+	for mcu in mcus:
+		mcu.maintain(now)
+		if mcu in readable:
+			#replies to commands read together leave with a single write
+			mcu.cork()
+			read_commands(mcu)
+			mcu.uncork()
 
+	#answer result requests held by connectors (result arrived or deadline expired),
+	# prefetch recurring result requests and sync the spools
+	for connectors in shd.values():
+		for connector in connectors:
+			connector.maintain(now)
 
-		# the sleep is really useful to prevent ciao to "cap" all CPU
-		# this could be increased/decreased (keep an eye on CPU usage)
-		time.sleep(0.01)
+	if dump_stats:
+		dump_stats = False
+		log_stats()
 
+log_stats()
+for connectors in shd.values():
+	for connector in connectors:
+		connector.close_spool()
 logger.info("Exiting")
 sys.exit(0)
@@ -25,27 +25,510 @@
 #
 ###
 
-import os, sys, logging
-import json, hashlib
+import os, sys, time, logging
+import json, itertools, mmap, array
 from subprocess import check_call
+from threading import Lock
+from collections import OrderedDict, deque
 
 import settings
 from utils import *
+from ciaospool import Spool
+
+class Message(object):
+	""" Message handled by the core (from the "world" to the mcu or vice versa), it
+	carries the bookkeeping of the stash and of the fifos too, so a queued message
+	costs a single slotted object. It becomes a dict only at the socket boundary. """
+
+	__slots__ = (
+		"type", "data", "checksum", "source_checksum", "result",
+		#stash: payload size and time of last use
+		"size", "used",
+		#fifo: priority class, deadline and time it has been queued
+		"priority", "deadline", "queued"
+	)
+
+	# type: in|out|response|result|transfer
+	def __init__(self, type, data, checksum = None, source_checksum = None):
+		self.type = type
+		self.data = data
+		#id of the interaction, sent to the connector with result requests
+		self.checksum = checksum
+		#id of the read interaction a response refers to
+		self.source_checksum = source_checksum
+		#result of a result request (None until the connector provides it)
+		self.result = None
+		self.size = 0
+		self.used = 0
+		self.priority = 0
+		self.deadline = 0
+		self.queued = 0
+
+	@classmethod
+	def from_json(cls, entry, type = "in"):
+		return cls(entry.get("type", type), entry["data"], entry.get("checksum"), entry.get("source_checksum"))
+
+	# the message as sent to the connector
+	def to_json(self):
+		entry = { "type": self.type, "data": self.data }
+		if not self.checksum is None:
+			entry["checksum"] = self.checksum
+		if not self.source_checksum is None:
+			entry["source_checksum"] = self.source_checksum
+		return entry
+
+	def payload_size(self):
+		size = payload_size(self.data)
+		if not self.result is None:
+			size += payload_size(self.result)
+		return size
+
+class Stash(object):
+	""" Interactions stash bounded by entry count, payload size and idle time (ttl).
+	Entries are kept in least recently used order, so the entry to evict is always
+	the first one and every limit is enforced in O(1). The entry being inserted or
+	updated is never evicted to make room for itself, an entry larger than max_bytes
+	alone is rejected instead. """
+
+	def __init__(self, max_entries = 0, max_bytes = 0, ttl = 0, on_evict = None, logger = None):
+		self.max_entries = max_entries
+		self.max_bytes = max_bytes
+		self.ttl = ttl
+		#function called with (checksum, entry) for every evicted entry
+		self.on_evict = on_evict
+		self.logger = logger if not logger is None else logging.getLogger("ciao.stash")
+		#checksum => Message (size and last use are kept by the message)
+		self.__entries = OrderedDict()
+		#stash is shared by the core main thread and the server thread
+		self.__lock = Lock()
+		self.bytes = 0
+		self.evictions = { "entries": 0, "bytes": 0, "ttl": 0 }
+		self.rejected = 0
+
+	def __len__(self):
+		return len(self.__entries)
+
+	def __contains__(self, checksum):
+		return checksum in self.__entries
+
+	def __getitem__(self, checksum):
+		with self.__lock:
+			return self.__touch(checksum)
+
+	# like stash[checksum] but None if missing (e.g. evicted by the other thread)
+	def get(self, checksum, default = None):
+		with self.__lock:
+			if not checksum in self.__entries:
+				return default
+			return self.__touch(checksum)
+
+	def __setitem__(self, checksum, entry):
+		self.put(checksum, entry)
+
+	# like stash[checksum] = entry but false if the entry has been rejected (too large),
+	# the entry it replaces is dropped anyway
+	def put(self, checksum, entry):
+		size = entry.payload_size()
+		rejected = self.max_bytes > 0 and size > self.max_bytes
+		with self.__lock:
+			evicted = []
+			if checksum in self.__entries:
+				old = self.__remove(checksum)
+				if rejected:
+					evicted.append((checksum, old))
+			if rejected:
+				self.rejected += 1
+			else:
+				entry.size = size
+				entry.used = time.time()
+				self.__entries[checksum] = entry
+				self.bytes += entry.size
+				evicted += self.__evict(time.time(), checksum)
+		self.__notify(evicted)
+		if rejected:
+			self.logger.warning("Rejected %s from stash: %d bytes, limit is %d" % (checksum, size, self.max_bytes))
+		return not rejected
+
+	def __delitem__(self, checksum):
+		with self.__lock:
+			self.__remove(checksum)
+
+	def pop(self, checksum, default = None):
+		with self.__lock:
+			if not checksum in self.__entries:
+				return default
+			return self.__remove(checksum)
+
+	# entry has been changed in place (e.g. its result has been added), update its size
+	def update(self, checksum):
+		with self.__lock:
+			if not checksum in self.__entries:
+				return
+			entry = self.__touch(checksum)
+			size = entry.payload_size()
+			self.bytes += size - entry.size
+			entry.size = size
+			evicted = self.__evict(time.time(), checksum)
+		self.__notify(evicted)
+		if self.max_bytes > 0 and size > self.max_bytes:
+			self.logger.warning("Stash entry %s exceeds the limit: %d bytes, limit is %d" % (checksum, size, self.max_bytes))
+
+	def clear(self):
+		with self.__lock:
+			self.__entries.clear()
+			self.bytes = 0
+
+	# drop least recently used entries while a limit is exceeded
+	def evict(self, now = None):
+		with self.__lock:
+			evicted = self.__evict(now if not now is None else time.time())
+		self.__notify(evicted)
+
+	# move the entry at the end (most recently used)
+	def __touch(self, checksum):
+		entry = self.__entries.pop(checksum)
+		entry.used = time.time()
+		self.__entries[checksum] = entry
+		return entry
+
+	def __remove(self, checksum):
+		entry = self.__entries.pop(checksum)
+		self.bytes -= entry.size
+		return entry
+
+	# the entry "keep" (the most recently used) is left even if still over a limit
+	def __evict(self, now, keep = None):
+		evicted = []
+		while self.__entries:
+			checksum, entry = next(self.__entries.iteritems())
+			if checksum == keep:
+				break
+			if self.max_entries > 0 and len(self.__entries) > self.max_entries:
+				reason = "entries"
+			elif self.max_bytes > 0 and self.bytes > self.max_bytes:
+				reason = "bytes"
+			elif self.ttl > 0 and entry.used + self.ttl <= now:
+				reason = "ttl"
+			else:
+				break
+			self.__remove(checksum)
+			self.evictions[reason] += 1
+			evicted.append((checksum, entry))
+		return evicted
+
+	#callbacks run outside the lock
+	def __notify(self, evicted):
+		if not self.on_evict is None:
+			for checksum, entry in evicted:
+				self.on_evict(checksum, entry)
+
+class MessageQueue(object):
+	""" FIFO of message ids for each priority class (see settings.priority_classes),
+	higher classes are served first. The deques give O(1) put/get, the index of the
+	queued ids gives O(1) length, membership and removal (removed ids are skipped by
+	get). Messages can have a deadline, expired ones are dropped by get. """
+
+	def __init__(self, classes = 1, on_expire = None):
+		self.__queues = [ deque() for i in range(classes) ]
+		self.__classes = range(classes)
+		#id => Message (priority class, deadline and time it has been queued)
+		self.__index = {}
+		#function called with the id of every expired message
+		self.on_expire = on_expire
+		#producer and consumer run on different threads (core and server): popleft
+		# and dict pop are atomic, so get/drop go without lock, put takes it since
+		# remove can replace a deque (compaction)
+		self.__lock = Lock()
+		#per class counters: served, expired, queue latency (sum and max, seconds)
+		self.stats = [ [0, 0, 0.0, 0.0] for i in range(classes) ]
+
+	def __len__(self):
+		return len(self.__index)
+
+	def __contains__(self, checksum):
+		return checksum in self.__index
+
+	# message.deadline is the absolute time (0 means none) after which it is dropped
+	def put(self, checksum, message):
+		message.queued = time.time()
+		with self.__lock:
+			self.__index[checksum] = message
+			self.__queues[message.priority].append(checksum)
+
+	# first id still queued (highest class first), None if the queue is empty
+	def get(self):
+		index = self.__index
+		now = time.time()
+		for priority in self.__classes:
+			#a deque replaced by remove() (compaction) meanwhile is read by the next get
+			queue = self.__queues[priority]
+			while queue:
+				try:
+					candidate = queue.popleft()
+				except IndexError:
+					break
+				#ids dropped or removed meanwhile are not in the index anymore
+				message = index.pop(candidate, None)
+				if message is None:
+					continue
+				stats = self.stats[priority]
+				if message.deadline and message.deadline <= now:
+					stats[1] += 1
+					if not self.on_expire is None:
+						self.on_expire(candidate)
+					continue
+				latency = now - message.queued
+				stats[0] += 1
+				stats[2] += latency
+				if latency > stats[3]:
+					stats[3] = latency
+				return candidate
+		return None
+
+	# highest class having queued ids, None if the queue is empty
+	def head_class(self):
+		for priority in self.__classes:
+			queue = self.__queues[priority]
+			try:
+				#removed ids at the head are discarded
+				while queue and not queue[0] in self.__index:
+					queue.popleft()
+			except IndexError:
+				continue
+			if queue:
+				return priority
+		return None
+
+	# drop the oldest id of the lowest class (to make room), None if the queue is empty
+	def drop(self):
+		for priority in reversed(self.__classes):
+			queue = self.__queues[priority]
+			while queue:
+				try:
+					candidate = queue.popleft()
+				except IndexError:
+					break
+				if not self.__index.pop(candidate, None) is None:
+					return candidate
+		return None
+
+	def remove(self, checksum):
+		if self.__index.pop(checksum, None) is None:
+			return
+		#removed ids are left in the deques, unless they are the most of them
+		with self.__lock:
+			if sum(map(len, self.__queues)) > 2 * len(self.__index) + 16:
+				self.__queues = [ deque(c for c in queue if c in self.__index) for queue in self.__queues ]
+
+class ResultCache(object):
+	""" Results of an action keyed by request content, so repeated requests are answered
+	by the core. A result is fresh for ttl seconds since it has been received, the least
+	recently used one is dropped when the cache holds max_entries results. """
+
+	def __init__(self, ttl = 60, max_entries = 32):
+		self.ttl = ttl
+		self.max_entries = max_entries
+		#request => (result, expiration time)
+		self.__results = OrderedDict()
+		self.stats = { "hits": 0, "misses": 0 }
+
+	def __len__(self):
+		return len(self.__results)
+
+	# result of request (None if missing or stale)
+	def get(self, request):
+		cached = self.__results.pop(request, None)
+		if cached is None or cached[1] <= time.time():
+			self.stats["misses"] += 1
+			return None
+		self.__results[request] = cached
+		self.stats["hits"] += 1
+		return cached[0]
+
+	def put(self, request, result):
+		self.__results.pop(request, None)
+		self.__results[request] = (result, time.time() + self.ttl)
+		while len(self.__results) > self.max_entries:
+			self.__results.popitem(last = False)
+
+class OutboundPipeline(object):
+	""" Filter/aggregation stage for the messages written by the mcu to a connector.
+	Messages are grouped by key (data field "key") and carry a numeric value (data
+	field "value"): a value is forwarded only if it changed by at least deadband
+	since the last forwarded one, values can be collected in windows (closed after
+	window seconds or count values) forwarded as a single message: [key, payload], where
+	payload is a JSON string holding all the values (aggregate "batch", e.g. "[20.1,20.3]")
+	or their statistics (aggregate e.g. ["min", "mean", "max"], "{"min":20.1,...}"), so
+	connectors publishing the second field (e.g. mqtt) forward it whole. Messages with
+	the value only (no key field) share a single key and forward [payload]. Packed
+	samples (array value field, or the whole message) go through one by one, the ones
+	passing the deadband are forwarded in an array of the same type.
+	Messages not matching (e.g. not numeric) are forwarded as they are. """
+
+	functions = {
+		"min": min,
+		"max": max,
+		"mean": lambda values: sum(values) / len(values),
+		"count": len
+	}
+
+	def __init__(self, key = 0, value = -1, deadband = 0, window = 0, count = 0, aggregate = "batch", max_keys = 256):
+		self.key = key
+		self.value = value
+		self.deadband = deadband
+		self.window = window
+		self.count = count
+		self.aggregate = aggregate
+		self.max_keys = max_keys
+		#key => [last forwarded value, values of the open window, window closing time]
+		self.__keys = {}
+		self.stats = { "in": 0, "out": 0, "filtered": 0 }
+
+	# messages to forward for a message written by the mcu (none, the same or an aggregate)
+	def process(self, data, now):
+		self.stats["in"] += 1
+		try:
+			if isinstance(data, array.array):
+				#packed samples alone: single key
+				key, field = None, data
+			else:
+				key = data[self.key]
+				field = data[self.value]
+				#key and value are the same field (e.g. "conn;w;23.5"): single key
+				if isinstance(data, list) and self.key % len(data) == self.value % len(data):
+					key = None
+			samples = field if isinstance(field, array.array) else [ field ]
+			values = [ float(sample) for sample in samples ]
+			state = self.__keys.get(key)
+		except (IndexError, KeyError, TypeError, ValueError), e:
+			return self.__forward([ data ])
+		if state is None:
+			if len(self.__keys) >= self.max_keys:
+				return self.__forward([ data ])
+			state = self.__keys[key] = [None, [], None]
+		passed = []
+		closed = []
+		for sample, value in zip(samples, values):
+			if self.deadband > 0 and not state[0] is None and abs(value - state[0]) < self.deadband:
+				self.stats["filtered"] += 1
+				continue
+			state[0] = value
+			if self.window <= 0 and self.count <= 0:
+				passed.append(sample)
+				continue
+			if not state[1]:
+				state[2] = now + self.window if self.window > 0 else None
+			state[1].append(value)
+			if self.count > 0 and len(state[1]) >= self.count:
+				closed.append(self.__close(key, state))
+		if len(passed) == len(samples):
+			return self.__forward([ data ])
+		elif passed:
+			return self.__forward([ self.__replace(data, array.array(field.typecode, passed)) ])
+		return self.__forward(closed)
+
+	# messages of the windows closed by time (all of them if force)
+	def flush(self, now, force = False):
+		closed = []
+		for key, state in self.__keys.items():
+			if state[1] and (force or (not state[2] is None and state[2] <= now)):
+				closed.append(self.__close(key, state))
+		return self.__forward(closed)
+
+	# closing time of the first window to close (None if there are not)
+	def next_deadline(self):
+		deadlines = [ state[2] for state in self.__keys.values() if state[1] and not state[2] is None ]
+		return min(deadlines) if deadlines else None
+
+	def __close(self, key, state):
+		samples = state[1]
+		state[1] = []
+		state[2] = None
+		if self.aggregate == "batch":
+			payload = samples
+		else:
+			payload = OrderedDict((name, self.functions[name](samples)) for name in self.aggregate)
+		payload = json.dumps(payload, separators = (",", ":"))
+		return [ payload ] if key is None else [ key, payload ]
+
+	# copy of the message with the samples that passed in place of the value field
+	def __replace(self, data, samples):
+		if isinstance(data, array.array):
+			return samples
+		data = list(data) if isinstance(data, list) else dict(data)
+		data[self.value] = samples
+		return data
+
+	def __forward(self, messages):
+		self.stats["out"] += len(messages)
+		return messages
 
 class CiaoConnector(object):
-	def __init__(self, name, conf, mcu_connection, registered = False,):
+	def __init__(self, name, conf, mcu_connection, registered = False, wakeup = None, ids = None, notify = None):
 		self.name = name
 		self.registered = registered
 		self.logger = logging.getLogger("ciao.connector." + self.name)
 		self.load_conf(conf)
 		self.mcu = mcu_connection
-		#interactions stash
-		self.stash = {}
+		#function to wake up the core main loop (called when a result arrives)
+		self.wakeup = wakeup
+		#function to wake up the server loop (called when a message for the connector is queued)
+		self.notify = notify
+		#interactions stash (bounded, see settings.conf["stash"])
+		self.stash = Stash(on_evict = self.evicted, logger = self.logger, **self.stash_limits)
+
+		#message ids: monotonic counter (base36 encoded) used as stash key and as
+		# reference on the wire, itertools.count is safe to share between threads
+		# the counter is shared by the instances (one for each mcu) of the same connector
+		self.__ids = ids if not ids is None else itertools.count(1)
+
+		#index of pending result requests by content (request => id)
+		# the mcu repeats the same request until the result is available
+		self.requests = {}
+		self.requests_by_id = {}
+		#recurring result requests to prefetch (request => period, last request, latency)
+		# and prefetched requests the mcu has not asked for yet
+		self.prefetch_tracks = {}
+		self.prefetched = set()
+
+		#pending requests of actions having a result cache (id => cache)
+		self.cached_requests = {}
+		#evictions can happen on the server thread too
+		self.requests_lock = Lock()
+
+		#result requests whose reply is held until the result arrives
+		# (or the deadline expires), id => (request, deadline)
+		self.waiting = {}
+
+		#payloads bigger than chunk_size (already serialized) waiting for the mcu to
+		# pull them in chunks are kept in the stash (see transfer_key), so they count
+		# toward its limits and expire with it
 
 		#list of requests handled with two FIFO queues
 		# in - OUTSIDE-IN (connectors -> MCU)
 		# out - INSIDE-OUT (MCU -> connectors)
-		self.fifo = { "in": [], "out": [] }
+		# messages are served by priority class, then in arrival order
+		classes = len(settings.priority_classes)
+		self.fifo = {
+			"in": MessageQueue(classes, on_expire = self.expired),
+			"out": MessageQueue(classes, on_expire = self.expired)
+		}
+
+		#true while the "in" queue is over its high watermark (until it drains to the low one)
+		self.throttled = False
+
+		#counters exposed through get_stats
+		self.stats = {
+			"polls": 0, "empty_polls": 0, "throttled": 0, "dropped": 0, "rejected": 0, "in_peak": 0,
+			"prefetch_cycles": 0, "prefetch_issued": 0, "prefetch_hits": 0, "prefetch_late": 0, "prefetch_unused": 0,
+			"routed": 0
+		}
+
+		#optional log of the messages in flight (one for each mcu), the ones left
+		# by the previous run are queued again
+		self.spool = None
+		if self.spool_conf["enabled"]:
+			self.open_spool()
 
 	def load_conf(self, conf):
 		#TODO
@@ -60,6 +543,67 @@ class CiaoConnector(object):
 
 		if "implements" in conf:
 			self.implements = conf['implements']
+		else:
+			self.implements = {}
+		self.build_dispatch()
+
+		#max size of a payload sent in a single reply, 0 means no limit
+		self.chunk_size = conf['chunk_size'] if "chunk_size" in conf else 0
+
+		#stash limits, defaults from core settings
+		self.stash_limits = dict(settings.conf["stash"])
+		if "stash" in conf:
+			self.stash_limits.update(conf['stash'])
+
+		#flow control of the "in" queue, defaults from core settings
+		self.backpressure = dict(settings.conf["backpressure"])
+		if "backpressure" in conf:
+			self.backpressure.update(conf['backpressure'])
+
+		#message spool settings, defaults from core settings
+		self.spool_conf = dict(settings.conf["spool"])
+		if "spool" in conf:
+			self.spool_conf.update(conf['spool'])
+
+		#weight of the connector when the mcu reads from any connector (ciao;r;any)
+		self.weight = conf['weight'] if "weight" in conf else 1
+		self.current_weight = 0
+
+	def open_spool(self):
+		path = os.path.join(settings.conf["paths"]["spool"], "%s.%s.spool" % (self.name, self.mcu.name))
+		try:
+			self.spool = Spool(path, self.spool_conf["size"], self.spool_conf["sync_interval"], self.spool_conf["sync_count"])
+		except (IOError, OSError, mmap.error), e:
+			self.logger.error("Cannot open spool %s: %s" % (path, e))
+			return
+		now = time.time()
+		replayed = 0
+		for checksum, (destination, entry, priority, deadline) in self.spool.load():
+			if deadline and deadline <= now:
+				continue
+			#ids are valid only in a run of the core, messages get new ones
+			message = Message.from_json(entry)
+			self.stash_put(destination, self.next_id(), message, settings.priority_classes[priority], deadline - now if deadline else 0)
+			replayed += 1
+		#the records of the previous run are dropped once put back
+		self.spool.compact()
+		if replayed:
+			self.logger.info("Replayed %d messages from spool" % replayed)
+
+	# the message left the core (delivered or dropped), it is not replayed anymore
+	def spool_done(self, checksum):
+		if not self.spool is None and self.spool.done(checksum) and not self.wakeup is None:
+			self.wakeup()
+
+	# sync the spool when a batch of records is complete
+	def sync_spool(self, now = None, force = False):
+		if not self.spool is None:
+			self.spool.sync(now, force)
+
+	def close_spool(self):
+		if not self.spool is None:
+			self.spool.close()
+			self.spool = None
 
 	def start(self):
 		self.logger.info("Received start command")
@@ -82,6 +626,46 @@ class CiaoConnector(object):
 			except Exception, e:
 				self.logger.error("Exception during %s stop: %s" % (self.name, e))
 
+	def get_stats(self):
+		stats = dict(self.stats)
+		stats["in"] = len(self.fifo["in"])
+		stats["out"] = len(self.fifo["out"])
+		for destination, fifo in self.fifo.items():
+			for name, (served, expired, latency, latency_max) in zip(settings.priority_classes, fifo.stats):
+				if served == 0 and expired == 0:
+					continue
+				key = "%s_%s_" % (destination, name)
+				stats[key + "served"] = served
+				stats[key + "expired"] = expired
+				#queue latency in milliseconds
+				if served > 0:
+					stats[key + "latency_avg"] = round(latency * 1000 / served, 2)
+				stats[key + "latency_max"] = round(latency_max * 1000, 2)
+		for spec in self.dispatch.values():
+			if not spec["pipeline"] is None:
+				for key, count in spec["pipeline"].stats.items():
+					stats["pipeline_%s_%s" % (spec["action"], key)] = count
+			if not spec["cache"] is None:
+				key = "cache_%s_" % spec["action"]
+				hits, misses = spec["cache"].stats["hits"], spec["cache"].stats["misses"]
+				stats[key + "hits"] = hits
+				stats[key + "misses"] = misses
+				stats[key + "hit_rate"] = round(float(hits) / (hits + misses), 3) if hits + misses else 0
+				stats[key + "entries"] = len(spec["cache"])
+		if not self.spool is None:
+			stats["spooled"] = len(self.spool)
+			for key, count in self.spool.stats.items():
+				stats["spool_" + key] = count
+		stats["stash_entries"] = len(self.stash)
+		stats["stash_bytes"] = self.stash.bytes
+		for reason, count in self.stash.evictions.items():
+			stats["evicted_" + reason] = count
+		stats["stash_rejected"] = self.stash.rejected
+		return stats
+
+	def next_id(self):
+		return base36(next(self.__ids))
+
 	def is_registered(self):
 		return self.registered
 
@@ -93,106 +677,493 @@ class CiaoConnector(object):
 		self.registered = False
 
 	# get element (hash) from stash "destination"
+	# elements are removed from stash too, except requests still waiting for their result
 	def stash_get(self, destination):
-		#TODO
-		# probably we should remove elements from stash (other than from fifo)
-		# if destination out and type response we should remove the original read too?
-		if len(self.fifo[destination]) > 0:
-			checksum = self.fifo[destination].pop(0)
-			return checksum, self.stash[checksum]
+		self.stash.evict()
+		checksum = self.fifo[destination].get()
+		#the server loop must read again from a blocked connector
+		if destination == "in" and self.throttled and len(self.fifo["in"]) <= self.backpressure["low_watermark"]:
+			if not self.notify is None:
+				self.notify()
+		while not checksum is None:
+			entry = self.stash.get(checksum)
+			if not entry is None:
+				if not (destination == "out" and entry.type == "result"):
+					self.stash.pop(checksum)
+				return checksum, entry
+			checksum = self.fifo[destination].get()
 		return False, False
 
-	# put element (hash) identified by "checksum" into stash "destination"
-	# type: out|result|response
-	def stash_put(self, destination, checksum, element):
+	# hysteresis on the "in" queue depth: full from the high watermark until it drains to the low one
+	def inbound_full(self):
+		high = self.backpressure["high_watermark"]
+		depth = len(self.fifo["in"])
+		if self.throttled:
+			self.throttled = depth > self.backpressure["low_watermark"]
+		elif high > 0 and depth >= high:
+			self.throttled = True
+			self.stats["throttled"] += 1
+		return self.throttled
+
+	# true if the connector socket can be read, i.e. unless the "block" policy is
+	# holding it back
+	def inbound_readable(self):
+		return self.backpressure["policy"] != "block" or not self.inbound_full()
+
+	# apply the drop policy before queueing a message from the "world",
+	# false if the message must be dropped ("newest" and "reject" policies, "block"
+	# when the socket is still read for the other mcus)
+	def inbound_admit(self):
+		policy = self.backpressure["policy"]
+		high = self.backpressure["high_watermark"]
+		depth = len(self.fifo["in"])
+		if policy == "block":
+			if not self.inbound_full():
+				return True
+			self.stats["dropped"] += 1
+			return False
+		if high <= 0 or depth < high:
+			return True
+		if policy == "oldest":
+			while len(self.fifo["in"]) >= high:
+				checksum = self.fifo["in"].drop()
+				if checksum is None:
+					break
+				self.stash.pop(checksum)
+				self.spool_done(checksum)
+				self.stats["dropped"] += 1
+			return True
+		self.stats["rejected" if policy == "reject" else "dropped"] += 1
+		return False
+
+	# stash is full (or entry expired): a dropped result request must be forgotten
+	def evicted(self, checksum, entry):
+		self.logger.debug("Evicted %s from stash" % checksum)
+		self.fifo["in"].remove(checksum)
+		self.fifo["out"].remove(checksum)
+		self.forget_request(checksum)
+		self.spool_done(checksum)
+
+	# a message has not been served before its deadline
+	def expired(self, checksum):
+		self.logger.debug("Message %s expired" % checksum)
+		self.stash.pop(checksum)
+		self.forget_request(checksum)
+		self.spool_done(checksum)
+
+	# drop result request "checksum" from the index of pending requests
+	def forget_request(self, checksum):
+		with self.requests_lock:
+			if checksum in self.requests_by_id:
+				del self.requests[self.requests_by_id.pop(checksum)]
+			self.cached_requests.pop(checksum, None)
+
+	# put element (Message) identified by "checksum" into stash "destination"
+	# or, for destination "result", set the result (data) of a result request
+	# priority (class name) and deadline (seconds) default to the ones of the connector
+	# false if the element has been rejected by the stash (too large)
+	def stash_put(self, destination, checksum, element, priority = None, deadline = None):
 		if destination == "result":
-			if checksum in self.stash:
-				self.stash[checksum]['result'] = element
+			entry = self.stash.get(checksum)
+			if not entry is None:
+				entry.result = element
+				self.stash.update(checksum)
+				if not self.wakeup is None:
+					self.wakeup()
 			else:
 				self.logger.warning("Obtaining result %s for missing checksum (%s)" % (element, checksum))
 		else:
-			self.stash[checksum] = element
-			self.fifo[destination].append(checksum)
-		return
+			element.priority, element.deadline = self.message_class(priority, deadline)
+			if not self.stash.put(checksum, element):
+				return False
+			#result requests are not spooled, the mcu repeats them until it gets the result
+			if not self.spool is None and element.type != "result":
+				record = [destination, element.to_json(), element.priority, element.deadline]
+				if self.spool.put(checksum, record) and not self.wakeup is None:
+					#the main loop has to schedule the sync
+					self.wakeup()
+			self.fifo[destination].put(checksum, element)
+			if destination == "in":
+				self.stats["in_peak"] = max(self.stats["in_peak"], len(self.fifo["in"]))
+			elif not self.notify is None:
+				self.notify()
+		return True
+
+	# priority class (index) and absolute deadline (0 means none) of a new message
+	def message_class(self, priority = None, deadline = None):
+		priority = self.priority if priority is None else self.priority_index(priority)
+		deadline = self.deadline if deadline is None else self.deadline_seconds(deadline, self.deadline)
+		return priority, time.time() + deadline if deadline > 0 else 0
+
+	def priority_index(self, name):
+		if self.valid_priority(name):
+			return settings.priority_classes.index(name)
+		return settings.priority_classes.index(settings.default_priority)
+
+	def valid_priority(self, name):
+		if isinstance(name, basestring) and name in settings.priority_classes:
+			return True
+		self.logger.warning("Unknown priority class %r" % (name,))
+		return False
+
+	# deadline (seconds, 0 means none) from a message or from the configuration,
+	# "default" if it is not a number (e.g. a string from a connector) or negative
+	def deadline_seconds(self, value, default):
+		try:
+			deadline = float(value)
+		except (TypeError, ValueError), e:
+			deadline = -1
+		if not deadline >= 0:
+			self.logger.warning("Invalid deadline %r" % (value,))
+			return default
+		return deadline
+
+	# true if the interaction "checksum" belongs to this instance (mcu)
+	def owns(self, checksum):
+		return checksum in self.stash
 
 	def has_result(self, checksum):
-		return checksum in self.stash and "result" in self.stash[checksum]
+		entry = self.stash.get(checksum)
+		return not entry is None and not entry.result is None
+
+	# send data to the mcu as reply to the interaction "checksum"
+	# payloads bigger than chunk_size are stored (once serialized) and the mcu
+	# is notified (status 2) of their size, it will pull them with chunk action
+	# reference (sent to the mcu in place of checksum) can carry more fields
+	def reply(self, checksum, data, reference = None):
+		if reference is None:
+			reference = checksum
+		payload = serialize(data)
+		if self.chunk_size > 0 and len(payload) > self.chunk_size:
+			if self.stash.put(self.transfer_key(checksum), Message("transfer", payload)):
+				self.mcu.write(2, reference, str(len(payload)))
+			else:
+				self.mcu.write(-1, "too_large")
+		else:
+			self.mcu.write(1, reference, payload)
+
+	# send to the mcu the slice [offset:offset+length] of a stored payload,
+	# the payload is released as soon as its last chunk has been sent
+	def send_chunk(self, fields):
+		try:
+			checksum = fields[0]
+			offset = int(fields[1])
+			length = int(fields[2])
+			if offset < 0 or length <= 0:
+				raise ValueError("offset/length out of range")
+		except (IndexError, ValueError), e:
+			self.logger.warning("invalid chunk request: %s" % ";".join(fields))
+			self.mcu.write(-1, "invalid_chunk")
+			return
+
+		key = self.transfer_key(checksum)
+		entry = self.stash.get(key)
+		if entry is None:
+			self.mcu.write(0, "no_transfer")
+			return
+		chunk = entry.data[offset:offset + length]
+		remaining = max(len(entry.data) - offset - len(chunk), 0)
+		if remaining == 0:
+			self.stash.pop(key)
+		self.mcu.write(1, remaining, chunk)
+
+	# stash key of the payload of interaction "checksum" waiting to be pulled in chunks,
+	# ids are base36 so it cannot clash with the one of a message
+	def transfer_key(self, checksum):
+		return "transfer:" + checksum
+
+	# true if the mcu could read a message from this connector
+	def has_inbound(self):
+		return self.is_registered() and len(self.fifo["in"]) > 0
+
+	# send to the mcu the next message from the "world", the reference can be
+	# extended with connector name (tagged) and messages still waiting (pending_hint)
+	# as "name,checksum,pending"
+	def read_inbound(self, pending_hint = False, tagged = False):
+		self.stats["polls"] += 1
+		checksum, entry = self.stash_get("in")
+		if not checksum:
+			self.stats["empty_polls"] += 1
+			self.mcu.write(0, "no_message")
+			return
+		reference = [checksum]
+		if tagged:
+			reference.insert(0, self.name)
+		if pending_hint:
+			reference.append(str(len(self.fifo["in"])))
+		self.reply(checksum, entry.data, ",".join(reference))
+		self.spool_done(checksum)
+
+	# the entry is taken in one step: since has_result() it could have been evicted
+	# by the server thread, the mcu gets no_result and its next poll asks again
+	def send_result(self, checksum, message):
+		entry = self.stash.pop(checksum)
+		if entry is None:
+			self.logger.debug("result %s evicted before being sent" % checksum)
+			self.forget_request(checksum)
+			self.mcu.write(0, "no_result")
+			return
+		result = entry.result
+		self.logger.debug("providing result for request %s" % checksum)
+		with self.requests_lock:
+			cache = self.cached_requests.get(checksum)
+		self.forget_request(checksum)
+		track = self.prefetch_tracks.get(message)
+		if not track is None and not track["asked"] is None:
+			latency = time.time() - track["asked"]
+			track["latency"] = latency if track["latency"] == 0 else 0.7 * track["latency"] + 0.3 * latency
+			track["asked"] = None
+		if not cache is None:
+			cache.put(message, result)
+		self.reply(checksum, result)
+
+	def next_deadline(self):
+		deadlines = [ deadline for message, deadline in self.waiting.values() ]
+		deadlines += [ self.prefetch_time(track) for track in self.prefetch_tracks.values() ]
+		deadlines += [ spec["pipeline"].next_deadline() for spec in self.dispatch.values() if not spec["pipeline"] is None ]
+		deadlines = [ deadline for deadline in deadlines if not deadline is None ]
+		if not self.spool is None and not self.spool.next_deadline() is None:
+			deadlines.append(self.spool.next_deadline())
+		return min(deadlines) if deadlines else None
+
+	# periodic work of the main loop: held result requests, prefetch and spool sync
+	def maintain(self, now):
+		self.serve_waiting(now)
+		self.prefetch(now)
+		self.flush_pipelines(now)
+		self.sync_spool(now)
+
+	# forward the aggregates of the pipeline windows closed by time
+	def flush_pipelines(self, now, force = False):
+		for spec in self.dispatch.values():
+			if not spec["pipeline"] is None:
+				for data in spec["pipeline"].flush(now, force):
+					self.stash_put("out", self.next_id(), Message("out", data), spec["priority"], spec["deadline"])
+
+	# answer the held result requests having a result or an expired deadline
+	def serve_waiting(self, now):
+		for checksum, (message, deadline) in self.waiting.items():
+			if self.has_result(checksum):
+				del self.waiting[checksum]
+				self.send_result(checksum, message)
+			elif deadline <= now:
+				del self.waiting[checksum]
+				self.mcu.write(0, "no_result")
+
+	#HANDLERS (one for each action direction), they get the fields following
+	# connector and action already split as expected by the dispatch table
+
+	#action from the "world" to MCU
+	def handle_in(self, spec, fields):
+		#optional hint about the messages still waiting
+		# it let the sketch drain bursts and back off when idle
+		self.read_inbound(spec["pending_hint"])
+
+	#action from MCU to the "world"
+	def handle_out(self, spec, fields):
+		message = fields[-1] if fields else ""
+		checksum = self.next_id()
 
-	def get_result(self, checksum, auto_delete=True):
-		result = self.stash[checksum]["result"]
-		if auto_delete:
-			del self.stash[checksum]
-		return result
+		data = unserialize(message, False)
+		if settings.PACKED_CODE in message and isinstance(data, list):
+			#packed numeric samples (decoded in one step) can be any entry,
+			# e.g. topic + samples, a payload made of samples only is the array
+			try:
+				data = [ unpack_samples(str(entry[1:])) if entry.startswith(settings.PACKED_CODE) else entry for entry in data ]
+			except ValueError, e:
+				self.logger.warning("invalid packed payload: %s" % e)
+				self.mcu.write(-1, "invalid_data")
+				return
+			if len(data) == 1:
+				data = data[0]
+		if spec["action"] == "writeresponse":
+			# checksum of read interaction we are responding to
+			# (first field after connector and action in writeresponse)
+			result = Message("response", data, source_checksum = fields[0])
+			stored = self.stash_put("out", checksum, result, spec["priority"], spec["deadline"])
+		elif not spec["pipeline"] is None and isinstance(data, (list, dict, array.array)):
+			#filtered/aggregated, the mcu gets "done" anyway
+			stored = True
+			for data in spec["pipeline"].process(data, time.time()):
+				stored &= self.stash_put("out", self.next_id(), Message("out", data), spec["priority"], spec["deadline"])
+		else:
+			result = Message("out", data)
+			stored = self.stash_put("out", checksum, result, spec["priority"], spec["deadline"])
+		if stored:
+			self.mcu.write(1, "done")
+		else:
+			self.mcu.write(-1, "too_large")
+
+	#action is a request from MCU aiming to get a result
+	def handle_result(self, spec, fields):
+		message = fields[-1] if fields else ""
+		cache = spec["cache"]
+		with self.requests_lock:
+			checksum = self.requests.get(message)
+		#a fresh result of the same request is answered by the core
+		if checksum is None and not cache is None:
+			result = cache.get(message)
+			if not result is None:
+				self.reply(self.next_id(), result)
+				return
+		#the mcu starts asking for this request (again)
+		if not spec["prefetch"] is None and (checksum is None or checksum in self.prefetched):
+			self.track_request(spec, message, checksum)
+		if checksum is None:
+			checksum = self.new_request(spec, message)
+
+		if self.has_result(checksum):
+			self.send_result(checksum, message)
+		#optional server side wait (seconds) for the result, the reply is held
+		# instead of answering no_result (not inside batch replies)
+		elif spec["wait"] > 0 and not self.mcu.in_batch():
+			self.waiting[checksum] = (message, time.time() + spec["wait"])
+		else:
+			self.mcu.write(0, "no_result")
+
+	# send a result request to the connector, returns its id
+	def new_request(self, spec, message):
+		with self.requests_lock:
+			checksum = self.next_id()
+			self.requests[message] = checksum
+			self.requests_by_id[checksum] = message
+			if not spec["cache"] is None:
+				self.cached_requests[checksum] = spec["cache"]
+		result = Message("result", unserialize(message, False), checksum)
+		self.stash_put("out", checksum, result, spec["priority"], spec["deadline"])
+		return checksum
 
-	def run(self, short_action, command):
-		#retrieve real action value from short one (e.g. "r" => "read" )
-		#action = settings.allowed_actions[short_action]['map']
-		action = settings.actions_map[short_action]
+	# update the period (unless configured) of a recurring result request, checksum
+	# is the request already sent by a prefetch (None if there is not)
+	def track_request(self, spec, message, checksum):
+		now = time.time()
+		track = self.prefetch_tracks.get(message)
+		if track is None:
+			if len(self.prefetch_tracks) >= spec["prefetch"].get("max_requests", 16):
+				return
+			track = self.prefetch_tracks[message] = {
+				"spec": spec,
+				"message": message,
+				"period": spec["prefetch"].get("period"),
+				"latency": 0.0,
+				"fetched": None
+			}
+		elif not "period" in spec["prefetch"]:
+			interval = now - track["last"]
+			track["period"] = interval if track["period"] is None else 0.7 * track["period"] + 0.3 * interval
+		track["last"] = now
+		track["asked"] = None
+		self.stats["prefetch_cycles"] += 1
+		if checksum is None:
+			#connector latency is learned from the requests not prefetched
+			track["asked"] = now
+		else:
+			self.prefetched.discard(checksum)
+			self.stats["prefetch_hits" if self.has_result(checksum) else "prefetch_late"] += 1
+
+	# time to send the next request of a tracked one: its expected connector
+	# latency (or the configured lead) before the mcu is expected to ask for it
+	def prefetch_time(self, track):
+		if track["period"] is None or track["fetched"] == track["last"] or track["message"] in self.requests:
+			return None
+		lead = max(track["spec"]["prefetch"].get("lead", 0), 1.5 * track["latency"])
+		return track["last"] + max(track["period"] - lead, 0)
+
+	# re-issue the recurring result requests about to be asked by the mcu, the
+	# ones not asked for a few periods are forgotten
+	def prefetch(self, now):
+		for message, track in self.prefetch_tracks.items():
+			if track["period"] is None:
+				continue
+			if now > track["last"] + 3 * track["period"] + 1:
+				del self.prefetch_tracks[message]
+				#a result fetched long ago must not be served
+				checksum = self.requests.get(message)
+				if checksum in self.prefetched:
+					self.prefetched.discard(checksum)
+					self.fifo["out"].remove(checksum)
+					self.stash.pop(checksum)
+					self.forget_request(checksum)
+					self.stats["prefetch_unused"] += 1
+				continue
+			when = self.prefetch_time(track)
+			if when is None or when > now:
+				continue
+			self.prefetched.add(self.new_request(track["spec"], message))
+			track["fetched"] = track["last"]
+			self.stats["prefetch_issued"] += 1
+
+	def handle_chunk(self, spec, fields):
+		self.send_chunk(fields)
+
+	def handle_unknown(self, spec, fields):
+		self.logger.warning("unknown behaviour action: %s" % spec["action"])
+		self.mcu.write(0, "no_match")
+
+	# build the dispatch table: short action (e.g. "r") => handler, count of fields
+	# after connector and action and options of the action, all resolved once
+	def build_dispatch(self):
+		handlers = {
+			"in": self.handle_in,
+			"out": self.handle_out,
+			"result": self.handle_result
+		}
+		self.dispatch = {}
+		#default class of messages from the "world" (from the implementation of the read action)
+		self.priority = settings.priority_classes.index(settings.default_priority)
+		self.deadline = 0
+		for short_action, action in settings.actions_map.items():
+			if action == "chunk":
+				implementation = { "direction": "chunk", "has_params": True }
+				handler = self.handle_chunk
+			elif action in self.implements:
+				implementation = self.implements[action]
+				handler = handlers.get(implementation['direction'], self.handle_unknown)
+			else:
+				continue
+			fields = settings.base_params[action] - 2
+			if "has_params" in implementation and implementation['has_params']:
+				fields += 1
+			self.dispatch[short_action] = {
+				"action": action,
+				"handler": handler,
+				"fields": fields,
+				"wait": implementation['wait'] if "wait" in implementation else 0,
+				"pending_hint": "pending_hint" in implementation and implementation['pending_hint'],
+				#priority class and deadline (seconds) of the messages of this action
+				"priority": implementation['priority'] if "priority" in implementation and self.valid_priority(implementation['priority']) else None,
+				"deadline": self.deadline_seconds(implementation['deadline'], None) if "deadline" in implementation else None,
+				#optional cache of the results ({ "ttl": seconds, "max_entries": count })
+				"cache": ResultCache(**implementation['cache']) if "cache" in implementation else None,
+				#optional refresh-ahead of recurring requests ({ "period": seconds, "lead": seconds },
+				# both learned if missing)
+				"prefetch": implementation['prefetch'] if "prefetch" in implementation else None,
+				#optional filter/aggregation of the messages written by the mcu (see OutboundPipeline)
+				"pipeline": OutboundPipeline(**implementation['pipeline']) if "pipeline" in implementation else None
+			}
+			if implementation['direction'] == "in":
+				spec = self.dispatch[short_action]
+				if not spec["priority"] is None:
+					self.priority = self.priority_index(spec["priority"])
+				if not spec["deadline"] is None:
+					self.deadline = spec["deadline"]
 
+	# run the action requested by the mcu, data is the part of the command
+	# following connector and action (e.g. "topic;value" for "mqtt;w;topic;value")
+	def run(self, short_action, data):
 		if not self.is_registered():
 			self.logger.warning("Connector %s not yet registered" % self.name)
 			self.mcu.write(0, "no_connector")
-		elif not action in self.implements:
-			self.logger.warning("Connector %s does not implement %s" % (self.name, action))
+		elif not short_action in self.dispatch:
+			self.logger.warning("Connector %s does not implement %s" % (self.name, settings.actions_map[short_action]))
 			self.mcu.write(0, "no_action")
 		else:
-			required_params = settings.base_params[action]
-			if not "has_params" in self.implements[action] or not self.implements[action]['has_params']:
-				required_params -= 1
-
-			#split has a "weird" behavior, the number passed (required_params) indicates
-			#the count of matches of the character should be found (i.e. 2 will split the string in three parts)
-			params = command.split(";", required_params)
-			#TODO
-			# after split we could check if len(params) match expected required_params value
-
-			#action from the "world" to MCU
-			if self.implements[action]['direction'] == 'in':
-				pos, entry = self.stash_get("in")
-				if pos:
-					self.mcu.write(1, pos, entry["data"])
-				else:
-					self.mcu.write(0, "no_message")
-
-			#action from MCU to the "world"
-			elif self.implements[action]['direction'] == 'out':
-				message = params[required_params]
-				checksum = get_checksum(message, False)
-
-				data = unserialize(message, False)
-				if action == "writeresponse":
-					result = {
-						"type": "response",
-						# checksum of read interaction we are responding to
-						# [0]connector,[1]action,[2]checksum (fixed positions in writeresponse)
-						"source_checksum": params[2],
-						"data": data
-					}
-				else:
-					result = {
-						"type": "out",
-						"data": data
-					}
-				self.stash_put("out", checksum, result)
-				self.mcu.write(1, "done")
-
-			#action is a request from MCU aiming to get a result
-			elif self.implements[action]['direction'] == 'result':
-				message = params[required_params]
-				checksum = get_checksum(message)
-				if not checksum in self.stash:
-					result = {
-						"type": "result",
-						"data": unserialize(message, False),
-						"checksum": checksum
-					}
-					self.stash_put("out", checksum, result)
-					self.mcu.write(0, "no_result")
-				elif self.has_result(checksum):
-					self.logger.debug("providing result for request %s" % checksum)
-					self.mcu.write(1, checksum, self.get_result(checksum))
-				else:
-					self.mcu.write(0, "no_result")
+			spec = self.dispatch[short_action]
+			#split has a "weird" behavior, the number passed indicates the count of
+			# matches of the character should be found (i.e. 2 will split the string in three parts)
+			fields = data.split(";", spec["fields"] - 1) if spec["fields"] > 0 else []
+			if len(fields) < spec["fields"]:
+				self.logger.warning("missing params for %s: %s" % (spec["action"], data))
+				self.mcu.write(-1, "unknown_command")
 			else:
-				self.logger.warning("unknown behaviour action: %s" % action)
-				self.mcu.write(0, "no_match")
+				spec["handler"](spec, fields)
@@ -25,13 +25,28 @@
 #
 ###
 
-import abc
-import serial, time, utils, os
+import abc, array
+import time, utils, os, settings
 import sys, atexit, termios, io
+import socket, pty, tty
 
 class CiaoMcu(object):
 	__metaclass__ = abc.ABCMeta
 
+	#initial size of the output buffer, it grows (doubling) if a reply does not fit
+	outbuf_size = 4096
+
+	def __init__(self):
+		#name used in logs and stats (set by the core when more mcus are served)
+		self.name = "mcu"
+		#replies are encoded into a single preallocated buffer and sent with one write
+		self._outbuf = bytearray(self.outbuf_size)
+		self._outlen = 0
+		self._corked = False
+		#replies collected while answering a batch frame (None outside a batch)
+		self._batch = None
+		self.stats = { "replies": 0, "bytes": 0, "writes": 0 }
+
 	@abc.abstractmethod
 	def start(self):
 		""" Connect to MCU"""
@@ -48,8 +63,9 @@ class CiaoMcu(object):
 		return
 
 	@abc.abstractmethod
-	def write(self, status, message, data):
-		""" Gets value and create a message to write to the MCU """
+	def transmit(self, data):
+		""" Send a buffer (memoryview) to the MCU, returns the number of write calls used
+		or None if the link is down (data will be sent again by the next send) """
 		return
 
 	@abc.abstractmethod
@@ -57,12 +73,149 @@ class CiaoMcu(object):
 		""" Flushes data from the buffer """
 		return
 
+	@abc.abstractmethod
+	def fileno(self):
+		""" File descriptor to wait on (select/poll) for incoming data """
+		return
+
+	def pending(self):
+		""" True if a complete command is already buffered and can be read without blocking """
+		return False
+
+	def ready(self):
+		""" True if the transport can be waited on (select), i.e. it is connected """
+		return True
+
+	def next_deadline(self):
+		""" Time of the next maintain() the transport needs (None if not needed) """
+		return None
+
+	def maintain(self, now):
+		""" Called by the core at every loop, e.g. to reconnect the link """
+		return
+
+	def encode(self, status, message, data = None):
+		output = [ str(status), str(message) ]
+		if not data is None:
+			#data could be already serialized (e.g. chunks of a stored payload)
+			if not isinstance(data, array.array):
+				data = utils.serialize(data)
+			output.append(data.tostring())
+		return ";".join(output)
+
+	def write(self, status, message, data = None):
+		""" Gets value and create a message to write to the MCU """
+		reply = self.encode(status, message, data)
+		self.stats["replies"] += 1
+		if self._batch is None:
+			#4 (ASCII) means end trasmit (like newline but via a non-printable char)
+			self.__enqueue(reply + chr(4))
+		else:
+			self._batch.append(reply)
+
+	def begin_batch(self):
+		""" Collect the following replies, they will be sent as a single batch reply """
+		self._batch = []
+
+	def end_batch(self):
+		""" Send the replies collected since begin_batch() as one EOT-terminated frame """
+		batch, self._batch = self._batch, None
+		self.__enqueue(settings.BATCH_SEP_CODE.join(batch) + chr(4))
+
+	def in_batch(self):
+		return not self._batch is None
+
+	def __enqueue(self, reply):
+		end = self._outlen + len(reply)
+		while end > len(self._outbuf):
+			self._outbuf.extend(bytearray(len(self._outbuf)))
+		self._outbuf[self._outlen:end] = reply
+		self._outlen = end
+		if not self._corked:
+			self.send()
+
+	def cork(self):
+		""" Hold replies into the output buffer until uncork() is called """
+		self._corked = True
+
+	def uncork(self):
+		""" Send every reply held since cork() with a single write """
+		self._corked = False
+		self.send()
+
+	def send(self):
+		if self._outlen == 0:
+			return
+		size = self._outlen
+		writes = self.transmit(memoryview(self._outbuf)[:size])
+		if writes is None:
+			#link down: replies stay into the buffer until the next send
+			return
+		self._outlen = 0
+		self.stats["writes"] += writes
+		self.stats["bytes"] += size
+
+	def get_stats(self):
+		stats = dict(self.stats)
+		if stats["replies"]:
+			stats["bytes_per_reply"] = float(stats["bytes"]) / stats["replies"]
+			stats["writes_per_reply"] = float(stats["writes"]) / stats["replies"]
+		return stats
+
+class FrameAssembler(object):
+	""" Incremental receive buffer, it gives back only complete (newline terminated) commands """
+
+	def __init__(self, terminator = "\n"):
+		self.__terminator = terminator
+		self.__buffer = bytearray()
+		#start of the first frame not yet consumed
+		self.__start = 0
+		#position where the terminator search has to resume
+		self.__scan = 0
+		#terminator position of the next complete frame (-1 if not found yet)
+		self.__end = -1
+
+	def feed(self, data):
+		#consumed bytes are dropped only when they are the larger part of the buffer,
+		# a partial frame stays in place until then
+		if self.__start > 0 and self.__start * 2 >= len(self.__buffer):
+			del self.__buffer[:self.__start]
+			self.__scan -= self.__start
+			if self.__end >= 0:
+				self.__end -= self.__start
+			self.__start = 0
+		self.__buffer.extend(data)
+
+	def pending(self):
+		if self.__end < 0:
+			self.__end = self.__buffer.find(self.__terminator, self.__scan)
+			if self.__end < 0:
+				self.__scan = len(self.__buffer)
+		return self.__end >= 0
+
+	def next(self):
+		if not self.pending():
+			return None
+		frame = str(self.__buffer[self.__start:self.__end + 1])
+		self.__start = self.__scan = self.__end + 1
+		self.__end = -1
+		return frame
+
+	def clear(self):
+		del self.__buffer[:]
+		self.__start = self.__scan = 0
+		self.__end = -1
+
 class StdIO(CiaoMcu):
 
 	def __init__(self, settings, logger):
+		CiaoMcu.__init__(self)
 		self.__handler = None
+		self.__frames = FrameAssembler()
 		self.__settings = settings;
 		self.__logger = logger;
+		#stdin reached EOF (e.g. the process at the other end exited)
+		self.__eof = False
 
 	def start(self):
 		#return input.read()
@@ -83,16 +236,33 @@ class StdIO(CiaoMcu):
 	def stop(self):
 		return
 
+	def fileno(self):
+		return self.__handler.fileno()
+
+	# stdin cannot be reopened: after EOF it is not selected anymore
+	def ready(self):
+		return not self.__eof
+
 	def read(self):
-		return self.__handler.readline()
+		#a single read from the descriptor, complete lines are served from the buffer
+		if not self.__frames.pending():
+			data = os.read(self.__handler.fileno(), 4096)
+			if not data:
+				self.__logger.warning("MCU input closed (EOF), stopped reading from it")
+				self.__eof = True
+			self.__frames.feed(data)
+		return self.__frames.next() or ""
 
-	def write(self, status, message, data = None):
-		output = [ str(status), str(message) ]
-		if not data is None:
-			data = utils.serialize(data)
-			output.append(data.tostring())
-		#4 (ASCII) means end trasmit (like newline but via a non-printable char)
-		os.write(sys.stdout.fileno(), ";".join(output)+ chr(4))
+	def pending(self):
+		return self.__frames.pending()
+
+	def transmit(self, data):
+		count = 0
+		while len(data) > 0:
+			written = os.write(sys.stdout.fileno(), data)
+			data = data[written:]
+			count += 1
+		return count
 
 	# enable/disable echo on tty
 	def __enable_echo(self, fd, enabled):
@@ -107,6 +277,11 @@ class StdIO(CiaoMcu):
 	def flush(self):
 		termios.tcflush(sys.stdin, termios.TCIOFLUSH)
 		sys.stdout.flush()
+		self.__frames.clear()
+
+	@classmethod
+	def from_conf(cls, conf, logger):
+		return cls(settings, logger)
 
 	# flush stdin before starting service
 	# it prevents answering to requests sent before Ciao Core is really up and running
@@ -115,70 +290,268 @@ class StdIO(CiaoMcu):
 
 class Serial(CiaoMcu):
 
+	#delay (seconds) between reconnection attempts, doubled at every failure
+	backoff_min = 0.1
+	backoff_max = 10
+
 	def __init__(self, baseport, baudrate, logger):
+		CiaoMcu.__init__(self)
 		self.__serial = None
+		self.__frames = FrameAssembler()
 		#self.__conn_status = False
 		self.__port = None
 		self.__baseport = baseport
 		self.__baudrate = baudrate
 		self.__logger = logger
+		#reconnection status: when the link went down, next attempt and its delay
+		self.__down_since = None
+		self.__retry_at = None
+		self.__backoff = self.backoff_min
+		self.stats.update({ "disconnections": 0, "recovery_time": 0.0, "max_recovery_time": 0.0 })
 
-	def __connect(self):
-		try :
-			#self.__conn_status = False
-			#if not self.__serial is None:
-			#	self.__serial.close()
-			#	time.sleep(30)
-
-			if not os.path.exists(self.__baseport):
-				self.__logger.error(self.__baseport + " not found. Maybe there are problems. Exiting Ciao.")
-				exit(1)
-
-			self.__logger.debug("Connecting to " + self.__baseport + " at " + str(self.__baudrate) + " baud")
-			self.__serial = serial.Serial(self.__baseport, self.__baudrate, timeout = 0)
-			#self.__conn_status = True
+	def __open(self):
+		#pyserial is needed only by this transport
+		import serial
+		self.__logger.debug("Connecting to " + self.__baseport + " at " + str(self.__baudrate) + " baud")
+		self.__serial = serial.Serial(self.__baseport, self.__baudrate, timeout = 0)
 
+	# the link is closed and reopened in place by maintain(): core, stash and
+	# connectors stay alive, replies not sent yet stay in the output buffer
+	def __disconnect(self, e):
+		self.__logger.warning("Problems with MCU link (%s), trying reconnection..." % e)
+		try:
+			self.__serial.close()
 		except Exception, e:
-			raise ValueError(e)
+			pass
+		self.__serial = None
+		self.__frames.clear()
+		self.__down_since = time.time()
+		self.__retry_at = self.__down_since
+		self.__backoff = self.backoff_min
+		self.stats["disconnections"] += 1
 
 	def flush(self):
 		if not self.__serial is None:
 			self.__serial.flush()
 			self.__serial.flushInput()
 			self.__serial.flushOutput()
+		self.__frames.clear()
 
-	def __kill_ciao(self):
-		self.__serial.close()
-		utils.kill_connectors_by_pids()
-		os.system(' kill -9 `/usr/bin/pgrep -f "python -u ciao.py"` ')
-
+	# a port missing at boot (e.g. adapter not plugged yet) is retried by maintain()
 	def start(self):
-		self.__connect()
+		#a missing pyserial instead is a configuration error (start fails)
+		import serial
+		try:
+			self.__open()
+		except Exception, e:
+			self.__disconnect(e)
 
 	def stop(self):
 		#self.__conn_status = False
-		self.__serial.close()
+		if not self.__serial is None:
+			self.__serial.close()
+
+	def fileno(self):
+		return self.__serial.fileno()
+
+	def ready(self):
+		return not self.__serial is None
+
+	def next_deadline(self):
+		return self.__retry_at if self.__serial is None else None
+
+	def maintain(self, now):
+		if not self.__serial is None or now < self.__retry_at:
+			return
+		try:
+			self.__open()
+		except Exception, e:
+			self.__retry_at = now + self.__backoff
+			self.__backoff = min(self.__backoff * 2, self.backoff_max)
+			self.__logger.debug("Reconnection failed (%s), next attempt in %.1fs" % (e, self.__retry_at - now))
+			return
+
+		recovery = time.time() - self.__down_since
+		self.stats["recovery_time"] += recovery
+		self.stats["max_recovery_time"] = max(self.stats["max_recovery_time"], recovery)
+		self.__down_since = self.__retry_at = None
+		self.__logger.info("MCU link recovered in %.3fs" % recovery)
+		#replay the replies left in the output buffer while the link was down
+		self.send()
+
+	def pending(self):
+		return self.__frames.pending()
 
 	def read(self):
 		#if self.__conn_status:
 		try:
-			return self.__serial.readline()
+			#pull everything the port has with one read, commands split
+			# across reads are completed by the following ones
+			if not self.__frames.pending():
+				self.__frames.feed(self.__serial.read(max(1, self.__serial.inWaiting())))
+			return self.__frames.next() or ""
 		except Exception, e:
-			self.__logger.warning("Problems when reading from MCU, trying reconnection...")
-			#self.__connect()
-			self.__kill_ciao()
+			self.__disconnect(e)
+			return ""
 
-	def write(self, status, message, data = None):
-		#if self.__conn_status:
+	def transmit(self, data):
+		if self.__serial is None:
+			return None
 		try:
-			output = [ str(status), str(message) ]
-			if not data is None:
-				data = utils.serialize(data)
-				output.append(data.tostring())
-			send = ";".join(output)+ chr(4)
-			for i in send:
-				self.__serial.write(i)
+			self.__serial.write(data)
+			return 1
 		except Exception, e:
-			self.__logger.warning("Problems when writing to MCU, trying reconnection...")
-			self.__kill_ciao()
-			#self.__connect()
+			self.__disconnect(e)
+			return None
+
+	@classmethod
+	def from_conf(cls, conf, logger):
+		mcu = cls(conf["port"], conf["baud"], logger)
+		if "backoff_min" in conf:
+			mcu.backoff_min = conf["backoff_min"]
+		if "backoff_max" in conf:
+			mcu.backoff_max = conf["backoff_max"]
+		return mcu
+
+class Stream(CiaoMcu):
+	""" Base for transports exchanging data through a plain file descriptor """
+
+	def __init__(self, logger):
+		CiaoMcu.__init__(self)
+		self._fd = None
+		self._frames = FrameAssembler()
+		self._logger = logger
+
+	def fileno(self):
+		return self._fd
+
+	def read(self):
+		if not self._frames.pending():
+			try:
+				data = os.read(self._fd, 4096)
+			except OSError, e:
+				self._logger.warning("Problems when reading from MCU (%s): %s" % (self.name, e))
+				data = ""
+			if not data:
+				self.disconnected()
+			self._frames.feed(data)
+		return self._frames.next() or ""
+
+	def pending(self):
+		return self._frames.pending()
+
+	def transmit(self, data):
+		count = 0
+		try:
+			while len(data) > 0:
+				written = os.write(self._fd, data)
+				data = data[written:]
+				count += 1
+		except OSError, e:
+			self._logger.warning("Problems when writing to MCU (%s): %s" % (self.name, e))
+			self.disconnected()
+		return count
+
+	def flush(self):
+		self._frames.clear()
+
+	def disconnected(self):
+		""" Called when the other side closed the stream """
+		return
+
+class Tcp(Stream):
+	""" Simulated MCU connected through a TCP socket (the core listens, the MCU connects) """
+
+	def __init__(self, host, port, logger):
+		Stream.__init__(self, logger)
+		self.__address = (host, port)
+		self.__server = None
+		self.__client = None
+
+	def start(self):
+		self.__server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.__server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.__server.bind(self.__address)
+		self.__server.listen(1)
+		#until a MCU connects, select waits on the listening socket
+		self._fd = self.__server.fileno()
+		self._logger.info("Waiting for MCU on tcp %s:%d" % self.__address)
+
+	def stop(self):
+		self.disconnected()
+		self.__server.close()
+
+	def read(self):
+		if self.__client is None:
+			self.__client, address = self.__server.accept()
+			self.__client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+			self._fd = self.__client.fileno()
+			self._logger.info("MCU connected from %s:%d" % address)
+			return ""
+		return Stream.read(self)
+
+	def transmit(self, data):
+		if self.__client is None:
+			return 0
+		return Stream.transmit(self, data)
+
+	def disconnected(self):
+		if not self.__client is None:
+			self._logger.info("MCU disconnected")
+			self.__client.close()
+			self.__client = None
+			self._fd = self.__server.fileno()
+			self._frames.clear()
+
+	@classmethod
+	def from_conf(cls, conf, logger):
+		return cls(conf["host"] if "host" in conf else "localhost", conf["port"], logger)
+
+class Pty(Stream):
+	""" Simulated MCU attached to a pseudo terminal, it opens the slave side like a serial port """
+
+	def __init__(self, link, logger):
+		Stream.__init__(self, logger)
+		#optional path of a symlink to the slave side (e.g. /tmp/ttyCIAO)
+		self.__link = link
+		self.__slave = None
+
+	def start(self):
+		self._fd, self.__slave = pty.openpty()
+		#the slave is kept open by the core too: the master never sees EOF/EIO
+		# when the simulator closes and reopens the port
+		tty.setraw(self.__slave)
+		path = os.ttyname(self.__slave)
+		if self.__link:
+			if os.path.lexists(self.__link):
+				os.remove(self.__link)
+			os.symlink(path, self.__link)
+			path = self.__link
+		self._logger.info("MCU pseudo terminal available at %s" % path)
+
+	def stop(self):
+		os.close(self._fd)
+		os.close(self.__slave)
+		if self.__link and os.path.lexists(self.__link):
+			os.remove(self.__link)
+
+	def flush(self):
+		termios.tcflush(self.__slave, termios.TCIOFLUSH)
+		Stream.flush(self)
+
+	@classmethod
+	def from_conf(cls, conf, logger):
+		return cls(conf["link"] if "link" in conf else None, logger)
+
+#available transports, selected by "type" in settings.conf["mcus"] entries
+transports = {
+	"stdio": StdIO,
+	"serial": Serial,
+	"tcp": Tcp,
+	"pty": Pty
+}
+
+def create(conf, logger):
+	if not conf["type"] in transports:
+		raise ValueError("Unknown MCU transport: %s" % conf["type"])
+	return transports[conf["type"]].from_conf(conf, logger)
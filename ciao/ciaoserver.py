@@ -26,30 +26,81 @@
 ###
 
 import os, sys, logging
-import socket, asyncore
-import json
+import socket, asyncore, fcntl
+import json, re
 
 from utils import *
+from ciaoconnector import Message
+
+# compile the routes between connectors (see settings.conf["routes"]), the
+# connectors are resolved when a message is routed (the server starts before them)
+def load_routes(routes, logger):
+	compiled = []
+	for route in routes:
+		if not "from" in route or not "to" in route:
+			logger.warning("Route %s skipped: from/to missing" % route)
+			continue
+		try:
+			match = [ (field, re.compile(pattern)) for field, pattern in route.get("match", {}).items() ]
+		except re.error, e:
+			logger.warning("Route %s skipped: %s" % (route, e))
+			continue
+		compiled.append({
+			"from": route['from'],
+			"to": route['to'],
+			"match": match,
+			"mcu": route.get("mcu", False)
+		})
+	return compiled
+
+# field (by position or key) of message data, None if missing
+def data_field(data, field):
+	if isinstance(data, dict):
+		return data.get(field)
+	try:
+		return data[int(field)]
+	except (ValueError, IndexError, TypeError), e:
+		return None
 
 class CiaoHandler(asyncore.dispatcher_with_send):
-	def __init__(self, sock, name, shm):
+	def __init__(self, sock, name, shm, routes = []):
 		asyncore.dispatcher_with_send.__init__(self, sock)
 		self.name = name
 		self.shm = shm
-		self.shm[self.name].register()
+		#routes of the messages of this connector to other connectors
+		self.routes = [ route for route in routes if route["from"] == self.name ]
+		#a connector process serves every mcu, shm holds one instance (stash namespace) for each mcu
+		self.connectors = self.shm[self.name]
+		#instance to look at first for outgoing messages (round robin among mcus)
+		self.turn = 0
+		for connector in self.connectors:
+			connector.register()
+		#instance the message being written comes from
+		self.source = None
 		self.checksum = ""
-		self.data = ""
+		self.data = None
 		self.logger = logging.getLogger("ciao.handler." + self.name)
 		self.logger.debug('Started')
 
 	#this function must return true only if we have something
 	# to write - through socket - to the ciao connector
 	def writable(self):
-		checksum, entry = self.shm[self.name].stash_get("out")
-		if checksum:
-			self.checksum = checksum
-			self.data = entry
-			return True
+		count = len(self.connectors)
+		for i in range(count):
+			connector = self.connectors[(self.turn + i) % count]
+			checksum, entry = connector.stash_get("out")
+			if checksum:
+				self.turn = (self.turn + i + 1) % count
+				self.source = connector
+				self.checksum = checksum
+				self.data = entry
+				return True
+
+	#stop reading from the connector while all of its inbound queues are over the
+	# high watermark (backpressure "block" policy), tcp flow control pushes back on it,
+	# a mcu that stopped reading does not hold back the others (see inbound_admit)
+	def readable(self):
+		return any([ connector.inbound_readable() for connector in self.connectors ])
 
 	def handle_read(self):
 		message = self.recv(2048)
@@ -67,14 +118,33 @@ class CiaoHandler(asyncore.dispatcher_with_send):
 			self.logger.warning("String not empty but not JSON: %s" % message)
 		else:
 			if "checksum" in entry:
-				self.shm[self.name].stash_put("result", entry['checksum'], entry['data'])
+				#results go back to the mcu the request came from
 				checksum = entry['checksum']
+				owners = [ c for c in self.connectors if c.owns(checksum) ]
+				connector = owners[0] if owners else self.connectors[0]
+				connector.stash_put("result", checksum, entry['data'])
 			else:
-				checksum = get_checksum(message, False)
+				#messages from the "world" reach every mcu (with the same id), unless
+				# the connector addresses one of them (by position) with the "mcu" key
+				# or routes deliver them to other connectors only
+				if "mcu" in entry and 0 <= entry['mcu'] < len(self.connectors):
+					targets = [ self.connectors[entry['mcu']] ]
+				else:
+					targets = self.connectors
+				if self.routes and not self.route(entry):
+					targets = []
+				checksum = self.connectors[0].next_id()
 				self.logger.debug("handle_read (checksum) - %s" % checksum)
+				#full queues drop a message according to the connector policy
+				admitted = [ connector for connector in targets if connector.inbound_admit() ]
+				for connector in admitted:
+					message = Message("in", entry.get("data", []))
+					connector.stash_put("in", checksum, message, entry.get("priority"), entry.get("deadline"))
+				if targets and not admitted and self.connectors[0].backpressure["policy"] == "reject":
+					self.logger.warning("Inbound queue full, message rejected")
+					self.send(json.dumps({ "status": -1, "checksum": checksum, "error": "queue_full" }))
+					return
 
-				self.shm[self.name].stash_put("in", checksum, entry)
-				
 			# connector MUST receive a feedback from core
 			result = {
 				"status" : 1,
@@ -82,16 +152,46 @@ class CiaoHandler(asyncore.dispatcher_with_send):
 			}
 			self.send(json.dumps(result))
 
+	# deliver the message to the connectors of the matching routes,
+	# returns false if the mcu must not get it
+	def route(self, entry):
+		data = entry.get("data", [])
+		to_mcu = True
+		for route in self.routes:
+			matched = True
+			for field, pattern in route["match"]:
+				value = data_field(data, field)
+				if value is None or not pattern.search(unicode(value)):
+					matched = False
+					break
+			if not matched:
+				continue
+			if not route["to"] in self.shm:
+				self.logger.debug("Route to %s: connector not enabled" % route["to"])
+				continue
+			destination = self.shm[route["to"]][0]
+			if not destination.is_registered():
+				self.logger.debug("Route to %s: connector not registered" % route["to"])
+				continue
+			destination.stash_put("out", destination.next_id(), Message("out", data))
+			self.connectors[0].stats["routed"] += 1
+			to_mcu = to_mcu and route["mcu"]
+		return to_mcu
+
 	def handle_write(self):
-		self.send(json.dumps(self.data))
-		self.data = ""
+		#messages become JSON only here
+		self.send(json.dumps(self.data.to_json(), default=json_default))
+		self.source.spool_done(self.checksum)
+		self.source = None
+		self.data = None
 		self.checksum = ""
 
 	def handle_close(self):
 		self.close()
 		self.logger.debug('Closed')
 		#notify to server that this connector has disconnected
-		self.shm[self.name].unregister()
+		for connector in self.connectors:
+			connector.unregister()
 
 	def handle_error(self):
 		nil, t, v, tbinfo = asyncore.compact_traceback()
@@ -109,6 +209,32 @@ class CiaoHandler(asyncore.dispatcher_with_send):
 		self.handle_close()
 
 
+#self-pipe watched by the asyncore loop: the core main thread writes a byte into it
+# when a message for the connectors is queued, so the loop wakes up immediately
+class Waker(asyncore.file_dispatcher):
+	def __init__(self):
+		pipe_r, self.pipe_w = os.pipe()
+		#file_dispatcher makes the read end non blocking
+		fcntl.fcntl(self.pipe_w, fcntl.F_SETFL, fcntl.fcntl(self.pipe_w, fcntl.F_GETFL) | os.O_NONBLOCK)
+		asyncore.file_dispatcher.__init__(self, pipe_r)
+		os.close(pipe_r)
+
+	def notify(self):
+		try:
+			os.write(self.pipe_w, "\0")
+		except OSError, e:
+			#pipe full: the loop has already been woken up
+			pass
+
+	def writable(self):
+		return False
+
+	def handle_read(self):
+		try:
+			self.recv(512)
+		except OSError, e:
+			pass
+
 class CiaoServer(asyncore.dispatcher):
 
 	# default host to listen
@@ -126,6 +252,7 @@ class CiaoServer(asyncore.dispatcher):
 		self.clients = []
 		self.shm = shm
 		self.logger = logging.getLogger("ciao.server")
+		self.routes = load_routes(conf.get("routes", []), self.logger)
 
 		if "host" in conf['server']:
 			self.host = conf['server']['host']
@@ -173,11 +300,11 @@ class CiaoServer(asyncore.dispatcher):
 					if not data['name'] in self.shm:
 						self.logger.warning('No connectors enabled with name %s' % data['name'])
 						sock.close()
-					elif self.shm[data['name']].is_registered():
+					elif self.shm[data['name']][0].is_registered():
 						self.logger.error('Connector %s already registered' % data['name'])
 						sock.close()
 					else:
-						handler = CiaoHandler(sock, data['name'], self.shm)
+						handler = CiaoHandler(sock, data['name'], self.shm, self.routes)
 						self.clients.append(handler)
 			except ValueError, e:
 				self.logger.error('Exception: new client not presented properly %s' % hello)
@@ -189,6 +316,16 @@ class CiaoServer(asyncore.dispatcher):
 			if c != source_client:
 				c.send(message)
 
+waker = None
+
+#wake up the asyncore loop (thread safe, called by the core main thread)
+def wakeup():
+	if not waker is None:
+		waker.notify()
+
 def init(conf, shm):
+	global waker
+	waker = Waker()
 	server = CiaoServer(conf, shm)
-	asyncore.loop(0.05)
\ No newline at end of file
+	#every queued message wakes the loop up, the timeout is just a safety net
+	asyncore.loop(1)
\ No newline at end of file
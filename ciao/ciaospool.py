@@ -0,0 +1,193 @@
+###
+# This file is part of Arduino Ciao
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Copyright 2015 Arduino Srl (http://www.arduino.org/)
+#
+# authors:
+# _giuseppe[at]arduino[dot]org
+#
+###
+
+import os, time, logging
+import mmap, struct, zlib, json
+from threading import Lock
+from collections import OrderedDict
+
+from utils import json_default
+
+class Spool(object):
+	""" Append-only log of the messages in flight, mapped in memory. Every queued
+	message is appended as a "put" record and every delivered (or dropped) one as a
+	"done" record, records are synced to disk in batches (sync_count records or
+	sync_interval seconds) instead of one by one. At startup the messages without a
+	"done" record are replayed, the log is compacted once its garbage is the most of it. """
+
+	#record header: payload length and crc32 of the payload
+	header = struct.Struct("<II")
+
+	def __init__(self, path, size = 262144, sync_interval = 1.0, sync_count = 64):
+		self.path = path
+		self.size = size
+		self.sync_interval = sync_interval
+		self.sync_count = sync_count
+		self.logger = logging.getLogger("ciao.spool." + os.path.basename(path))
+		#live records (id => encoded put record), kept to compact without reading the file
+		self.__live = OrderedDict()
+		self.__live_bytes = 0
+		#records written since the last sync and time of the first of them
+		self.__pending = 0
+		self.__pending_since = None
+		#puts come from the core main thread and from the server thread
+		self.__lock = Lock()
+		self.stats = { "puts": 0, "dones": 0, "syncs": 0, "compactions": 0 }
+		self.__records = self.__open()
+
+	# messages still in flight when the log has been opened, list of (id, record)
+	# in the original order, the caller puts them back then compacts the log: until
+	# then the log keeps them (a crash in between replays them twice, not never)
+	def load(self):
+		records = self.__records
+		self.__records = []
+		return records
+
+	# write the live records only into a new log (synced)
+	def compact(self):
+		with self.__lock:
+			self.__rewrite()
+
+	# returns true if the record is the first one waiting for a sync
+	def put(self, record_id, record):
+		data = self.__encode(["p", record_id, record])
+		with self.__lock:
+			self.__append(data)
+			self.__live[record_id] = data
+			self.__live_bytes += len(data)
+			self.stats["puts"] += 1
+			return self.__pending == 1
+
+	def done(self, record_id):
+		with self.__lock:
+			data = self.__live.pop(record_id, None)
+			if data is None:
+				return False
+			self.__live_bytes -= len(data)
+			self.__append(self.__encode(["d", record_id]))
+			self.stats["dones"] += 1
+			return self.__pending == 1
+
+	def __len__(self):
+		return len(self.__live)
+
+	# time of the next sync (None if nothing is waiting for it)
+	def next_deadline(self):
+		if self.__pending_since is None:
+			return None
+		if self.__pending >= self.sync_count:
+			return self.__pending_since
+		return self.__pending_since + self.sync_interval
+
+	# sync the records written so far if a batch is complete (or force), then compact
+	# the log if garbage (delivered messages) takes more than half of it
+	def sync(self, now = None, force = False):
+		deadline = self.next_deadline()
+		if deadline is None:
+			return
+		if not force and deadline > (now if not now is None else time.time()):
+			return
+		with self.__lock:
+			self.__map.flush()
+			self.__pending = 0
+			self.__pending_since = None
+			self.stats["syncs"] += 1
+			if self.__offset > self.size / 2 and self.__live_bytes < self.__offset / 2:
+				self.__rewrite()
+
+	def close(self):
+		self.sync(force = True)
+		with self.__lock:
+			self.__map.close()
+			os.close(self.__fd)
+
+	def __encode(self, record):
+		payload = json.dumps(record, default = json_default, separators = (",", ":"))
+		return self.header.pack(len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+
+	def __append(self, data):
+		if self.__offset + len(data) + self.header.size > self.size:
+			#no more room: drop the garbage, then grow the log if needed
+			self.__rewrite(len(data))
+		self.__map[self.__offset:self.__offset + len(data)] = data
+		self.__offset += len(data)
+		self.__pending += 1
+		if self.__pending_since is None:
+			self.__pending_since = time.time()
+
+	# map the log and read back its records, the log ends at the first empty (zero
+	# length) or corrupted record (e.g. a write interrupted by a crash)
+	def __open(self):
+		directory = os.path.dirname(self.path)
+		if directory and not os.path.isdir(directory):
+			os.makedirs(directory)
+		self.__fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0600)
+		self.size = max(self.size, os.fstat(self.__fd).st_size)
+		os.ftruncate(self.__fd, self.size)
+		self.__map = mmap.mmap(self.__fd, self.size)
+		self.__offset = 0
+		records = OrderedDict()
+		while self.__offset + self.header.size <= self.size:
+			length, crc = self.header.unpack_from(self.__map, self.__offset)
+			start = self.__offset + self.header.size
+			if length == 0 or start + length > self.size:
+				break
+			payload = self.__map[start:start + length]
+			if zlib.crc32(payload) & 0xffffffff != crc:
+				self.logger.warning("Corrupted record at %d, log truncated" % self.__offset)
+				break
+			record = json.loads(payload)
+			if record[0] == "p":
+				records[record[1]] = record[2]
+			else:
+				records.pop(record[1], None)
+			self.__offset = start + length
+		return records.items()
+
+	# write the live records into a new log (at least "room" bytes larger) and
+	# replace the old one with it, a crash keeps one of the two complete
+	def __rewrite(self, room = 0):
+		data = "".join(self.__live.values())
+		size = self.size
+		while len(data) + room + self.header.size > size / 2:
+			size *= 2
+		temp = self.path + ".tmp"
+		with open(temp, "wb") as log:
+			log.write(data)
+			log.truncate(size)
+			log.flush()
+			os.fsync(log.fileno())
+		os.rename(temp, self.path)
+		self.__map.close()
+		os.close(self.__fd)
+		self.__fd = os.open(self.path, os.O_RDWR)
+		self.size = size
+		self.__map = mmap.mmap(self.__fd, self.size)
+		self.__offset = len(data)
+		self.__pending = 0
+		self.__pending_since = None
+		self.stats["compactions"] += 1
@@ -42,7 +42,11 @@ class MQTTCiao(CiaoThread):
 		for data_decoded in self.decode_multiple(data):
 			if "status" in data_decoded:
 				if self.write_pending:
-					self.shd["requests"][data_decoded["checksum"]] = self.data_pending
+					if data_decoded["status"] < 0:
+						#core inbound queue is full (backpressure "reject" policy)
+						self.logger.warning("message rejected by core: %s" % data_decoded.get("error"))
+					else:
+						self.shd["requests"][data_decoded["checksum"]] = self.data_pending
 					self.data_pending = None
 					self.write_pending = False
 				else:
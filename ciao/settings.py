@@ -40,7 +40,8 @@ conf = {
 	# path starting with slash will be handled like absolute ones
 	"paths": {
 		"conf" : "conf/",
-		"connectors" : "connectors/"
+		"connectors" : "connectors/",
+		"spool" : "spool/"
 	},
 	"log": {
 		"file" : "ciao.log",
@@ -49,17 +50,77 @@ conf = {
 		"maxSize" : 0.1 , # maxSize is expressed in MBytes
 		"maxRotate" : 5 # maxRotate expresses how much time logfile has to be rotated before deletion
 	},
+	# default limits of the stash of every connector (for each mcu), connectors can
+	# override them with "stash" in their configuration, 0 means no limit
+	#  max_entries - count of interactions kept
+	#  max_bytes - (approximate) size of their payloads
+	#  ttl - seconds an interaction is kept since it has been used the last time
+	"stash": {
+		"max_entries" : 1024,
+		"max_bytes" : 262144,
+		"ttl" : 600
+	},
+	# default flow control of the inbound ("in") queue of every connector (for each mcu),
+	# connectors can override it with "backpressure" in their configuration
+	#  high_watermark - queued messages at which the queue is full (0 means no limit)
+	#  low_watermark - queued messages at which a blocked connector is read again
+	#  policy - what to do when the queue is full:
+	#   block - stop reading from the connector socket (tcp pushes back on it), with
+	#    more mcus only once all of their queues are full (the full ones drop meanwhile)
+	#   oldest - drop the oldest queued message
+	#   newest - drop the incoming message
+	#   reject - drop the incoming message and answer the connector with status -1
+	"backpressure": {
+		"high_watermark" : 256,
+		"low_watermark" : 128,
+		"policy" : "block"
+	},
+	# default settings of the message spool (log of the messages in flight, replayed
+	# when the core restarts) of every connector (for each mcu), connectors can
+	# override them with "spool" in their configuration, e.g. { "enabled" : true }
+	#  size - initial size (bytes) of the log file, it grows if needed
+	#  sync_interval/sync_count - the log is synced to disk every sync_count records
+	#   or sync_interval seconds after the first record not synced yet
+	"spool": {
+		"enabled" : False,
+		"size" : 262144,
+		"sync_interval" : 1.0,
+		"sync_count" : 64
+	},
+	# routes of messages between connectors, handled by the core without the mcu
+	#  from/to - source and destination connector (it gets the message as an mcu write)
+	#  match - regular expressions the data fields (by position or key) must match
+	#  mcu - deliver the message to the mcu too (default false)
+	# e.g. [ { "from" : "mqtt", "match" : { "0" : "^sensors/" }, "to" : "file" } ]
+	"routes": [],
 	"tian": {
 		"baud" : 4000000,
 		"port" : "/dev/ttySAMD"
-	}
+	},
+	# mcus served by this core (every one gets its own stash namespace), each entry
+	# selects a transport by "type" (stdio, serial, tcp, pty) plus its params, e.g.
+	# [ { "type" : "serial", "port" : "/dev/ttyUSB0", "baud" : 115200 },
+	#   { "type" : "tcp", "host" : "localhost", "port" : 8901 },
+	#   { "type" : "pty", "link" : "/tmp/ttyCIAO" } ]
+	# if empty the transport is chosen by the board model (see boards)
+	"mcus": []
+}
+
+#default mcu transport for each board model (as reported by /proc/cpuinfo)
+boards = {
+	"ARDUINO YUN": { "type" : "stdio" },
+	"ARDUINO YUN-MINI": { "type" : "stdio" },
+	"ARDUINO CHIWAWA": { "type" : "stdio" },
+	"LININO ONE": { "type" : "stdio" },
+	"ARDUINO TIAN": { "type" : "serial", "port" : conf["tian"]["port"], "baud" : conf["tian"]["baud"] }
 }
 
 #map of actions accepted from Ciao Library (MCU-side)
 actions_map = {
 	"r": "read", #usually requires 2/3 params - connector;action;data(optional)
 	"w": "write", #usuallyrequires 3 params - connector;action;data
-	"wr": "writeresponse" #usually requires 4 params - connector;action;reference;data
+	"wr": "writeresponse", #usually requires 4 params - connector;action;reference;data
+	"c": "chunk" #requires 5 params - connector;action;reference;offset;length
 }
 
 #this is the number of default params the MCU will pass to Ciao
@@ -67,6 +128,7 @@ base_params = {
 	"read" : 2, # connector_name + action
 	"write" : 2, # connector_name + action
 	"writeresponse" : 3, # connector_name + action + checksum
+	"chunk" : 4, # connector_name + action + checksum + offset (length is the data)
 }
 
 
@@ -87,6 +149,24 @@ TAB = "\t"
 # are not enough. Put all togheter the arguments and separate it with this char code.
 ARGS_SEP_CODE = chr(21)
 
+# ASCII code for End of Transmission Block - Used to pack many commands into a single
+# line (batch frame), replies to a batch are packed back in the same order with it.
+BATCH_SEP_CODE = chr(23)
+
+# ASCII code for Synchronous Idle - Marks a packed numeric payload (or entry of it, e.g.
+# after a topic): the marker is followed by the array type code (see packed_types) and
+# by the base64 encoding of the samples (little endian), e.g. chr(22) + "h" + base64(int16 samples)
+PACKED_CODE = chr(22)
+
+#array type codes accepted in packed payloads
+packed_types = "bBhHiIfd"
+
+#priority classes of connector messages, the first ones are served first; connectors
+# select one (and an optional deadline, in seconds) in their messages ("priority" and
+# "deadline" keys) or in implements entries (for every message of that action)
+priority_classes = ["high", "normal", "low"]
+default_priority = "normal"
+
 # ASCII code for Record Separator
 ENTRY_SEP_CODE = chr(30) #(non-printable char)
 
@@ -114,6 +194,8 @@ if not conf['paths']['conf'].startswith(os.sep): #relative path
 	conf['paths']['conf'] = basepath + conf['paths']['conf']
 if not conf['paths']['conf'].endswith(os.sep):
 	conf['paths']['conf'] += os.sep
+if not conf['paths']['spool'].startswith(os.sep): #relative path
+	conf['paths']['spool'] = basepath + conf['paths']['spool']
 if not conf['log']['file'].startswith(os.sep): #relative path
 	conf['log']['file'] = basepath + conf['log']['file']
 
@@ -29,7 +29,7 @@ import os, sys, time, logging
 import tty #, termios
 import re, array
 import socket
-import hashlib
+import base64
 import logging
 from logging.handlers import RotatingFileHandler
 
@@ -59,13 +59,6 @@ def get_logger(logname):
 def clean_command(command):
 	return command.rstrip()
 
-def is_valid_command(command):
-	#a valid command must contain at least two fields: connector and action
-	elements = command.split(";", 2)
-	if len(elements) >= 2 and elements[1] in settings.actions_map:
-		return elements[:2]
-	return False, False
-
 #SERIALIZATION FUNCTIONS
 # serialize passed dict/list, atm it works only for one level object not nested ones
 def serialize(data):
@@ -84,57 +77,60 @@ def serialize(data):
 
 # unserialize passed dict/list, atm it works only for one level object not nested ones
 def unserialize(source, from_array = True):
-	#create a clone of original array or a new one from a string
+	#entries and key/value pairs are found by split, without walking the data byte by byte
 	if from_array:
-		data = array.array("B", source)
-	else:
-		data = array.array("B")
-		for c in source:
-			data.append(ord(c))
+		source = array.array("B", source).tostring()
 
-	#identifying data type
-	try:
-		index = data.index(ord(settings.KV_SEP_CODE))
+	entries = source.split(settings.ENTRY_SEP_CODE)
+	if settings.KV_SEP_CODE in source:
 		result = {}
-	except ValueError, e:
-		try:
-			index = data.index(ord(settings.ENTRY_SEP_CODE))
-			result = []
-		except ValueError, e:
-			result = []
-
-	#converting bytearray into object
-	addr, size = data.buffer_info()
-	count = 0
-	if isinstance(result, dict):
-		params = ["",""]
-		param_index = 0
-		while count < size:
-			pick = data.pop(0)
-			count +=1
-			if pick == ord(settings.KV_SEP_CODE):
-				param_index = 1
-				params[param_index] = ""
-			elif pick == ord(settings.ENTRY_SEP_CODE):
-				result[escape(params[0], False)] = escape(params[1], False)
-				param_index = 0
-				params = ["", ""]
-			else:
-				params[param_index] += chr(pick)
-		if params[0] != "":
-			result[escape(params[0], False)] = escape(params[1], False)
-	else:
-		entry = ""
-		while count < size:
-			pick = data.pop(0)
-			count +=1
-			if pick == ord(settings.ENTRY_SEP_CODE):
-				result.append(escape(entry, False))
-				entry = ""
-			else:
-				entry += chr(pick)
-		result.append(escape(entry, False))
-	return result
+		for index, entry in enumerate(entries):
+			params = entry.split(settings.KV_SEP_CODE)
+			#the value is what follows the last key/value separator
+			value = params[-1] if len(params) > 1 else ""
+			#an empty trailing entry is not a pair
+			if index < len(entries) - 1 or params[0] != "":
+				result[escape(params[0], False)] = escape(value, False)
+		return result
+	return [ escape(entry, False) for entry in entries ]
+
+#base64 as sent by the mcu (b64decode skips any other character instead of failing)
+base64_format = re.compile(r"^[A-Za-z0-9+/]*={0,2}\Z")
+
+# decode a packed numeric payload (type code + base64 of little endian samples)
+# into an array.array, it raises ValueError if the payload is not valid
+def unpack_samples(source):
+	if len(source) < 1 or not source[0] in settings.packed_types:
+		raise ValueError("unknown packed type")
+	if len(source[1:]) % 4 or not base64_format.match(source[1:]):
+		raise ValueError("invalid base64 encoding")
+	samples = array.array(source[0])
+	try:
+		samples.fromstring(base64.b64decode(source[1:]))
+	except TypeError, e:
+		raise ValueError(e)
+	if sys.byteorder == "big":
+		samples.byteswap()
+	return samples
+
+# convert to JSON types the objects the json module does not know
+# (packed samples are sent to connectors as list of numbers)
+def json_default(obj):
+	if isinstance(obj, array.array):
+		return obj.tolist()
+	raise TypeError("%r is not JSON serializable" % obj)
+
+# approximate size (bytes) of the payload of an entry, used to bound the stash memory
+def payload_size(data):
+	if isinstance(data, basestring):
+		return len(data)
+	elif isinstance(data, array.array):
+		return len(data) * data.itemsize
+	elif isinstance(data, dict):
+		return sum(payload_size(k) + payload_size(v) for k, v in data.items())
+	elif isinstance(data, (list, tuple)):
+		return sum(payload_size(v) for v in data)
+	return 8
 
 # escape/unescape string for serialization procedure
 def escape(s, encode = True):
@@ -143,16 +139,26 @@ def escape(s, encode = True):
 	else:
 		return s.decode('unicode-escape')
 
-# calculate (unique)? checksum from a string
-def get_checksum(msg, is_unique = True):
-	if not is_unique:
-		msg = str(time.time()) + msg
-	return hashlib.md5(msg.encode('unicode-escape')).hexdigest()
-
-# get the board name/model
+# encode a (non negative) integer in base36, used to keep message ids short on the wire
+BASE36_DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+def base36(number):
+	digits = ""
+	while True:
+		number, remainder = divmod(number, 36)
+		digits = BASE36_DIGITS[remainder] + digits
+		if number == 0:
+			return digits
+
+# get the board name/model (third and fourth field of the "machine" line in cpuinfo)
 def get_board_model():
-	import subprocess
-	return subprocess.check_output(['awk','''/machine/ {print $3,$4}''','/proc/cpuinfo']).strip('\n').upper()
+	try:
+		with open("/proc/cpuinfo") as cpuinfo:
+			for line in cpuinfo:
+				if "machine" in line:
+					return " ".join(line.split()[2:4]).upper()
+	except IOError, e:
+		pass
+	return ""
 
 # check version
 
@@ -179,7 +179,11 @@ class CiaoThread(Thread, asyncore.dispatcher_with_send):
 		for data_decoded in self.decode_multiple(data):
 			if "status" in data_decoded:
 				if self.write_pending:
-					self.shd["requests"][data_decoded["checksum"]] = self.data_pending
+					if data_decoded["status"] < 0:
+						#core inbound queue is full (backpressure "reject" policy)
+						self.logger.warning("message rejected by core: %s" % data_decoded.get("error"))
+					else:
+						self.shd["requests"][data_decoded["checksum"]] = self.data_pending
 					self.data_pending = None
 					self.write_pending = False
 				else:
@@ -314,7 +318,9 @@ class BaseConnector:
 
 	def __pre_handling(self, entry):
 		for index, item in enumerate(entry["data"]):
-			entry["data"][index] = item.replace(TAB_CODE, TAB).replace(NL_CODE, NL).replace(CR_CODE, CR)
+			#packed samples from the mcu arrive as numbers
+			if isinstance(item, basestring):
+				entry["data"][index] = item.replace(TAB_CODE, TAB).replace(NL_CODE, NL).replace(CR_CODE, CR)
 		self.__handler(entry)
 
 def load_config(cwd):
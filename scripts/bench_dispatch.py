@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+###
+# This file is part of Arduino Ciao
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Copyright 2015 Arduino Srl (http://www.arduino.org/)
+#
+###
+
+# Commands per second through the core dispatch (the parsing of handle_command
+# in ciao.py, then CiaoConnector.run) on a fixed command mix, with a stub mcu.
+# The core directory to load can be given, e.g. to compare with an older tree:
+#
+#   git worktree add /tmp/ciao-before <commit>
+#   python scripts/bench_dispatch.py /tmp/ciao-before/ciao
+#   python scripts/bench_dispatch.py
+#
+# usage: python scripts/bench_dispatch.py [ciao directory]
+
+import os, sys, time
+
+core = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ciao")
+sys.path.insert(0, os.path.abspath(core))
+import settings, utils
+from ciaoconnector import CiaoConnector
+
+#commands as sent by the mcu: mqtt write, mqtt read, shell result request, mqtt writeresponse
+mix = [
+	"mqtt;w;topic" + settings.ENTRY_SEP_CODE + "23.5",
+	"mqtt;r",
+	"shell;w;date",
+	"mqtt;wr;1a;ok"
+] * 2500
+repeats = 5
+#commands between two drains of the messages for the connectors (not timed)
+batch = 100
+
+confs = {
+	"mqtt": { "type": "standalone", "implements": {
+		"read": { "direction": "in", "has_params": False },
+		"write": { "direction": "out", "has_params": True },
+		"writeresponse": { "direction": "out", "has_params": True } } },
+	"shell": { "type": "standalone", "implements": {
+		"write": { "direction": "result", "has_params": True } } }
+}
+
+class Mcu(object):
+	name = "mcu"
+	def write(self, status, message, data = None):
+		pass
+	def in_batch(self):
+		return False
+
+#trees before the dispatch table: command validated by utils.is_valid_command,
+# the connector gets the whole command
+dispatch_table = not hasattr(utils, "is_valid_command")
+
+# what handle_command (ciao.py) does for a connector command
+def handle_command(connectors, cmd):
+	cmd = utils.clean_command(cmd)
+	if dispatch_table:
+		connector, sep, data = cmd.partition(";")
+		action, has_data, data = data.partition(";")
+		if sep and action in settings.actions_map and connector in connectors:
+			connectors[connector].run(action, data)
+	else:
+		connector, action = utils.is_valid_command(cmd)
+		if connector in connectors:
+			connectors[connector].run(action, cmd)
+
+best = 0
+for r in range(repeats):
+	#fresh connectors (empty stash and queues) for every run
+	connectors = dict((name, CiaoConnector(name, conf, Mcu())) for name, conf in confs.items())
+	for connector in connectors.values():
+		connector.register()
+	elapsed = 0
+	for first in range(0, len(mix), batch):
+		start = time.time()
+		for cmd in mix[first:first + batch]:
+			handle_command(connectors, cmd)
+		elapsed += time.time() - start
+		#what the server thread does, so the stash does not fill up
+		for connector in connectors.values():
+			while connector.stash_get("out")[0]:
+				pass
+	best = max(best, len(mix) / elapsed)
+print "%s: %.0f commands/s (best of %d runs of %d commands)" % (os.path.abspath(core), best, repeats, len(mix))
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+###
+# This file is part of Arduino Ciao
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Copyright 2015 Arduino Srl (http://www.arduino.org/)
+#
+###
+
+# Memory of a message left queued in a connector: growth of the resident set
+# for a number of messages stashed and never taken, for each kind of message
+# (from the world "in", to the world "out", "result" requested by the mcu).
+# Stash limits and backpressure are disabled so every message stays queued.
+# The core directory to load can be given, e.g. to compare with an older tree:
+#
+#   git worktree add /tmp/ciao-before <commit>
+#   python scripts/bench_memory.py /tmp/ciao-before/ciao
+#   python scripts/bench_memory.py
+#
+# usage: python scripts/bench_memory.py [ciao directory]
+
+import os, sys, gc
+
+core = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ciao")
+sys.path.insert(0, os.path.abspath(core))
+import settings
+settings.conf["stash"] = { "max_entries": 0, "max_bytes": 0, "ttl": 0 }
+if "backpressure" in settings.conf:
+	settings.conf["backpressure"]["high_watermark"] = 0
+import ciaoconnector
+from ciaoconnector import CiaoConnector
+
+#messages queued for each kind
+count = 50000
+
+confs = {
+	"mqtt": { "type": "standalone", "implements": {
+		"read": { "direction": "in", "has_params": False },
+		"write": { "direction": "out", "has_params": True } } },
+	"shell": { "type": "standalone", "implements": {
+		"write": { "direction": "result", "has_params": True } } }
+}
+
+class Mcu(object):
+	name = "mcu"
+	def write(self, status, message, data = None):
+		pass
+	def in_batch(self):
+		return False
+
+# resident set size (bytes) of the process
+def rss():
+	with open("/proc/self/statm") as statm:
+		return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+# a message from the world, as CiaoHandler stashes it
+def inbound(connector, i):
+	data = ["msg%d" % i]
+	#trees before Message kept a dict for every message
+	if hasattr(ciaoconnector, "Message"):
+		entry = ciaoconnector.Message("in", data)
+	else:
+		entry = { "data": data }
+	connector.stash_put("in", connector.next_id(), entry)
+
+kinds = [
+	("in", "mqtt", inbound),
+	("out", "mqtt", lambda connector, i: connector.run("w", "topic%d" % i + settings.ENTRY_SEP_CODE + "23.5")),
+	("result", "shell", lambda connector, i: connector.run("w", "date%d" % i))
+]
+
+print "%s: bytes per queued message (%d queued)" % (os.path.abspath(core), count)
+for kind, name, queue in kinds:
+	connector = CiaoConnector(name, confs[name], Mcu())
+	connector.register()
+	gc.collect()
+	before = rss()
+	for i in xrange(count):
+		queue(connector, i)
+	gc.collect()
+	print "%8s %6d" % (kind, (rss() - before) / count)
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+###
+# This file is part of Arduino Ciao
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Copyright 2015 Arduino Srl (http://www.arduino.org/)
+#
+###
+
+# Cost of a dequeue + enqueue on a connector fifo at a given queue depth:
+# MessageQueue against the plain list (append/pop(0)) the fifos used to be,
+# and the whole path of a message through a connector (stash_put + stash_get)
+# to compare it with.
+#
+# usage: python scripts/bench_queue.py [depth ...]
+
+import os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ciao"))
+import settings
+settings.conf["stash"] = { "max_entries": 0, "max_bytes": 0, "ttl": 0 }
+settings.conf["backpressure"]["high_watermark"] = 0
+from ciaoconnector import MessageQueue, Message, CiaoConnector
+
+depths = [ int(depth) for depth in sys.argv[1:] ] or [100, 256, 1024, 10000, 50000]
+#get+put pairs timed for each depth (best of repeats)
+rounds = 50000
+repeats = 5
+
+# the fifo before MessageQueue: ids in a list, messages in the stash dict
+def bench_list(depth):
+	fifo = [ str(i) for i in range(depth) ]
+	best = None
+	for r in range(repeats):
+		start = time.time()
+		for i in xrange(rounds):
+			fifo.append(fifo.pop(0))
+		elapsed = time.time() - start
+		best = elapsed if best is None else min(best, elapsed)
+	return best / rounds
+
+def bench_queue(depth):
+	queue = MessageQueue(len(settings.priority_classes))
+	priority = settings.priority_classes.index(settings.default_priority)
+	messages = {}
+	for i in range(depth):
+		message = Message("in", ["msg%d" % i])
+		message.priority = priority
+		messages[str(i)] = message
+		queue.put(str(i), message)
+	best = None
+	for r in range(repeats):
+		start = time.time()
+		for i in xrange(rounds):
+			checksum = queue.get()
+			queue.put(checksum, messages[checksum])
+		elapsed = time.time() - start
+		best = elapsed if best is None else min(best, elapsed)
+	return best / rounds
+
+class Mcu(object):
+	name = "mcu"
+	def write(self, *args):
+		pass
+
+# stash_put + stash_get of a message from the "world" with depth messages queued
+def bench_connector(depth):
+	conf = { "type": "standalone", "implements": { "read": { "direction": "in", "has_params": False } } }
+	connector = CiaoConnector("bench", conf, Mcu())
+	for i in range(depth):
+		connector.stash_put("in", connector.next_id(), Message("in", ["msg%d" % i]))
+	best = None
+	for r in range(repeats):
+		start = time.time()
+		for i in xrange(rounds):
+			checksum, message = connector.stash_get("in")
+			connector.stash_put("in", checksum, message)
+		elapsed = time.time() - start
+		best = elapsed if best is None else min(best, elapsed)
+	return best / rounds
+
+print "get+put per message (ns), best of %d runs of %d" % (repeats, rounds)
+print "%8s %12s %14s %12s" % ("depth", "list", "MessageQueue", "connector")
+for depth in depths:
+	print "%8d %12.0f %14.0f %12.0f" % (depth, bench_list(depth) * 1e9, bench_queue(depth) * 1e9, bench_connector(depth) * 1e9)